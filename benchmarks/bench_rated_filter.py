@@ -0,0 +1,77 @@
+""" Micro-benchmark of the "already rated" check of the new ratings (utils.valid_rating)
+
+    $ PYTHONPATH=. python benchmarks/bench_rated_filter.py [RATINGS] [DATABASE] [REDIS_URL]
+
+Fills a database (in memory by default, a file may be given) with RATINGS ratings
+and compares (in checks/second, for raters that did not rate the restaurant yet):
+    - before: the Rating query for every check
+    - after: the bloom filter (ratings.RatedFilter) warmed from the Rating table, the query runs only for its false positives.
+      The checks read the bits in memory, redis (the local stand-in by default) only keeps them: a real one
+      (e.g. redis://localhost:6379/15) changes the warm-up time, not the checks
+"""
+import os
+import sys
+import time
+
+from flask import Flask
+
+from restaurants.orm import db, Rating, Restaurant
+from restaurants.cache import redis_client
+from restaurants.ratings import rated_filter
+from restaurants.utils import valid_rating
+
+RESTAURANTS = 1000
+
+def fill(n):
+    db.session.execute(Restaurant.__table__.insert(), [{"name": "Rest %d" % i} for i in range(RESTAURANTS)])
+    for start in range(0, n, 10000):
+        db.session.execute(Rating.__table__.insert(), [
+            {"restaurant_id": i % RESTAURANTS + 1, "rater_id": i // RESTAURANTS + 1, "rating": i % 6, "marked": True}
+            for i in range(start, min(n, start + 10000))])
+    db.session.commit()
+
+def checks(n, count=20000):
+    """ The checks of count new raters """
+    raters = n // RESTAURANTS + 1
+    return [{"rater_id": raters + i + 1, "rating": 3} for i in range(count)]
+
+def measure(objs, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        for i,obj in enumerate(objs):
+            assert valid_rating(obj, i % RESTAURANTS + 1) is None
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(objs) / best
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    path = sys.argv[2] if len(sys.argv) > 2 and sys.argv[2] else None
+    url = sys.argv[3] if len(sys.argv) > 3 else "memory://"
+    if path is not None and os.path.exists(path):
+        os.remove(path)
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://" + ("/" + os.path.abspath(path) if path else "")
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        fill(n)
+        objs = checks(n)
+
+        rated_filter.configure(0, 0.01) # disabled
+        old = measure(objs)
+
+        client = redis_client(url)
+        rated_filter.configure(max(n, 1000) * 2, 0.01, client)
+        client.delete(rated_filter.key) # warmed from this database
+        start = time.perf_counter()
+        rated_filter.warm(lambda: db.session.query(Rating.restaurant_id, Rating.rater_id).yield_per(10000))
+        warm = time.perf_counter() - start
+        new = measure(objs)
+
+        stats = rated_filter.stats()
+        print("ratings: %d, filter: %d bits (%.1f MB), %d hashes, warmed in %.2f s" % (n, stats["bits"], stats["bits"] / 8e6, stats["hashes"], warm))
+        print("before: %10.0f checks/s" % old)
+        print("after:  %10.0f checks/s (x%.1f), %.2f%% of the checks queried the database" % (new, new/old, 100.0 * stats["false_positives"] / stats["checks"]))
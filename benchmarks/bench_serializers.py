@@ -0,0 +1,67 @@
+""" Micro-benchmark of the serialization of the restaurant list
+
+    $ PYTHONPATH=. python benchmarks/bench_serializers.py [ROWS]
+
+Compares (in rows/second, from the query to the encoded json):
+    - before: ORM instances, dump() scanning __dict__, framework json encoder (sorted keys)
+    - after: Core rows, precomputed Restaurant.serializer(), compact encoder (utils.dumps)
+"""
+import json
+import sys
+import time
+
+from flask import Flask
+
+from restaurants.orm import db, Restaurant
+from restaurants.utils import dumps, restaurants
+
+def old_dump(rest):
+    """ The dump() replaced by the serializers (limited to the exported fields, the later columns are internal) """
+    d = dict([(k,v) for k,v in rest.__dict__.items() if k in Restaurant._dump_fields])
+    d["closed_days"] = [int(day) for day in d["closed_days"]]
+    d["url"] = "/restaurants/"+str(d["id"])
+    return d
+
+def before():
+    return json.dumps([old_dump(p) for p in db.session.query(Restaurant)], sort_keys=True)
+
+def after():
+    serialize = Restaurant.serializer()
+    return dumps([serialize(row) for row in db.session.query(*serialize.columns)])
+
+def fill(n):
+    columns = [c.name for c in Restaurant.__table__.columns if c.name != "id"]
+    rows = []
+    for i in range(n):
+        r = dict([(k,v) for k,v in restaurants[i % len(restaurants)].items() if k in columns])
+        r["closed_days"] = ''.join([str(d) for d in r["closed_days"]])
+        r["name"] = "Rest %d" % i
+        rows.append(r)
+    db.session.execute(Restaurant.__table__.insert(), rows)
+    db.session.commit()
+
+def measure(f, n, runs=3):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        f()
+        elapsed = time.perf_counter() - start
+        db.session.remove() # do not reuse the identity map
+        best = elapsed if best is None else min(best, elapsed)
+    return n / best
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        fill(n)
+        assert json.loads(before()) == json.loads(after())
+        old = measure(before, n)
+        new = measure(after, n)
+        print("rows: %d" % n)
+        print("before: %10.0f rows/s" % old)
+        print("after:  %10.0f rows/s (x%.1f)" % (new, new/old))
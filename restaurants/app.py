@@ -1,23 +1,40 @@
 from datetime import date
 from logging import debug
-from restaurants.background import init_celery
+from restaurants.background import init_celery, init_scheduler, schedule_rating_update
 import connexion
 import datetime
 import logging
 import configparser
 import sys
 import os
+import tempfile
+import time
 import dateutil.parser
+import functools
+import itertools
 
-from flask import current_app
+from flask import current_app, Response, stream_with_context
+from werkzeug.http import unquote_etag
+from werkzeug.wrappers import Response as WerkzeugResponse
+from sqlalchemy import event
 
 from connexion import NoContent, request
 
-from restaurants.orm import db, Restaurant,Rating,Table
+from restaurants.orm import db, Restaurant,Rating,RatingArchive,Table, add_missing_columns, catalog_version, init_catalog, init_rating_aggregates
 
 from restaurants.utils import add_rating, add_table, del_restaurant, del_table, edit_table, get_future_bookings, put_fake_data, valid_openings, add_restaurant, edit_restaurant, valid_rating
+from restaurants.utils import decode_cursor, dumps, encode_cursor, json_response, keyset_filter, load_rating_histogram, load_restaurant, load_table, next_link
+from restaurants.utils import collection_etag, etag_header, load_version, make_etag, not_modified
+from restaurants.utils import DEADLINE, DeadlineExceeded, parse_deadline
 
-from restaurants.errors import Error, Error400, Error404, Error409, Error500
+from restaurants.errors import Error, Error400, Error404, Error409, Error500, Error504
+
+from restaurants.cache import bookings_cache, entity_cache, redis_client, search_cache
+from restaurants.ratings import rated_filter, rating_events, rating_queue
+from restaurants.scheduler import scheduler
+from restaurants.http_client import bookings_breaker, http_client
+
+from restaurants.search import drop_search_index, geo_search, init_geo_index, init_opening_index, init_search_index, opening_search, parse_point, restaurant_fts, text_search
 
 import sys
 sys.path.append("./restaurants/")
@@ -39,20 +56,119 @@ DEFAULT_CONFIGURATION = {
 
     "SQLALCHEMY_DATABASE_URI": "db/restaurants.db", # the database path/name
     "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    "USE_FTS": True, # use the full-text index for the text filters (disabled if sqlite has no fts5)
+    "USE_RTREE": True, # use the spatial index for the near search (disabled if sqlite has no rtree)
+    "PAGE_SIZE": 100, # default number of records in a page of the lists (limit=0 returns the whole list)
+    "EXPORT_CHUNK": 500, # number of restaurants read at once by the export
+    "CACHE_SIZE": 1024, # number of responses kept in the search cache (0 disables it)
+    "CACHE_TTL": 60, # seconds a response is kept in the search cache
+    "CACHE_VERSION_INTERVAL": 1, # seconds between the reads of the catalog version by the search cache (the writes of the other processes are seen after it)
+    "ENTITY_CACHE_URL": os.getenv("ENTITY_CACHE", ""), # redis shared by the processes for the restaurants and tables (memory:// for a local one, empty to disable)
+    "ENTITY_CACHE_TTL": 300, # seconds a record is kept in the entity cache
 
     "USE_MOCKS": False, # use mocks for external calls
     "TIMEOUT": 2, # timeout for external calls
+    "HTTP_POOL_SIZE": 10, # connections kept alive to each service (the calls beyond them open a new connection)
+    "HTTP_RETRIES": 2, # retries of the external calls failing to connect
+    "HTTP_RETRY_BACKOFF": 0.05, # seconds before the first retry (doubled at every retry, jittered)
+    "LATENCY_WINDOW": 200, # number of the last calls to a service whose latencies are kept
+    "TIMEOUT_PERCENTILE": 99, # the timeout of the external calls is TIMEOUT_MULTIPLIER times this percentile of their latencies (0 to always use TIMEOUT)
+    "TIMEOUT_MULTIPLIER": 2,
+    "TIMEOUT_MIN": 0.1, # seconds, the shortest adaptive timeout (TIMEOUT is the longest)
+    "HEDGE_PERCENTILE": 0, # the external calls slower than this percentile of the latencies send a duplicate request (0 disables it, e.g. 95)
+    "HEDGE_BUDGET": 0.1, # the duplicate requests sent by the hedging, as a fraction of the external calls
+    "BREAKER_FAILURES": 5, # consecutive failed calls to the bookings service that open its circuit breaker (0 disables it)
+    "BREAKER_RESET": 10, # seconds the open breaker rejects the calls before letting a probe through
+    "BREAKER_TRIALS": 1, # calls let through at a time by the half open breaker
+    "BOOKINGS_CACHE_SIZE": 1024, # number of restaurants/tables whose future bookings are cached (0 disables the cache, it needs BOOKINGS_CACHE_URL)
+    "BOOKINGS_CACHE_TTL": 5, # seconds the future bookings are cached (they are dropped at once when the bookings service notifies a change)
+    "BOOKINGS_CACHE_URL": os.getenv("BOOKINGS_CACHE", ""), # redis relaying the notified changes to all the processes (memory:// for a single process, empty disables the cache)
     "BOOK_SERVICE_URL": "http://bookings:8080", # bookings microservice url
 
     "COMMIT_RATINGS_AFTER": 10, # celery config for updating the ratings
+    "RATINGS_QUEUE_URL": os.getenv("RATINGS_QUEUE", ""), # redis list of the ratings in write-behind mode (memory:// for a local one, empty to write them at once)
+    "FLUSH_RATINGS_AFTER": 5, # seconds between the inserts of the queued ratings (write-behind mode)
+    "RATINGS_EVENTS_URL": os.getenv("RATINGS_EVENTS", ""), # redis of the pending rating updates (empty to update the ratings only every COMMIT_RATINGS_AFTER)
+    "RATINGS_DEBOUNCE": 2, # seconds the new ratings of a restaurant are collected before its rating is updated
+    "RATED_FILTER_CAPACITY": 1000000, # number of ratings the "already rated" bloom filter is sized for (0 disables it)
+    "RATED_FILTER_ERROR_RATE": 0.01, # false positive rate of the filter (the checks that still query the database)
+    "RATED_FILTER_URL": os.getenv("RATED_FILTER", ""), # redis keeping the filter, shared by the processes (memory:// for a single process, empty disables the filter)
+    "RATINGS_BATCH": 5000, # number of ratings counted in each transaction of check_ratings
+    "RECOMPUTE_CHUNK": 1000, # number of restaurants recomputed in each transaction of recompute_ratings
+    "RECOMPUTE_PARTITION": 10000, # range of restaurant ids recomputed by each parallel task of recompute_ratings
+    "RECOMPUTE_RATINGS": True, # run the weekly recompute_ratings (a consistency check, the ratings are exact)
+    "ARCHIVE_RATINGS": True, # run the daily archive_ratings (moves the old counted ratings out of the Rating table)
+    "RATINGS_ARCHIVE_AFTER": 30, # days a counted rating stays in the Rating table before it is archived
+    "SCHEDULER": False, # run the periodic tasks in a thread of the app instead of the celery worker (no worker and broker needed)
+    "SCHEDULER_JITTER": 0.1, # fraction of their interval the runs of the scheduler are randomly moved by
+    "SCHEDULER_LOCK": os.path.join(tempfile.gettempdir(), "restaurants-scheduler.lock"), # file locked by the only process of the node running the tasks
     "result_backend" : os.getenv("BACKEND", "redis://localhost:6379"),
     "broker_url" : os.getenv("BROKER", "redis://localhost:6379"),
 }
 
-def get_restaurants(name=None, opening_time=None, open_day=None, cuisine_type=None, menu=None):
+def cached(f):
+    """ Serve the successful responses of an endpoint from the search cache
+
+    The entries are identified by the endpoint and its (normalized) arguments,
+    all of them are dropped when the version of the catalog changes. The version is read
+    at most every CACHE_VERSION_INTERVAL seconds, and after the writes of the process (see catalog_committed).
+    The conditional requests matching the ETag of the cached response get a 304.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        search_cache.check_version(catalog_version)
+        params = []
+        for k,v in sorted(kwargs.items()):
+            if v is not None:
+                params.append((k, tuple(sorted(v)) if type(v) == list else v))
+        key = (f.__name__, args, tuple(params))
+
+        found,ret = search_cache.get(key)
+        if found:
+            if type(ret) == tuple and isinstance(ret[0], bytes): # encoded response
+                etag = dict(ret[2]).get("ETag")
+                ret = Response(ret[0], ret[1], ret[2])
+            else:
+                etag = ret[2].get("ETag") if len(ret) > 2 else None
+            if etag is not None:
+                return not_modified(unquote_etag(etag)[0]) or ret
+            return ret
+
+        ret = f(*args, **kwargs)
+        if isinstance(ret, WerkzeugResponse):
+            if ret.status_code == 200:
+                search_cache.put(key, (ret.get_data(), ret.status_code, list(ret.headers.items())))
+        elif ret[1] == 200:
+            search_cache.put(key, ret)
+        return ret
+    return wrapper
+
+def catalog_committed(session):
+    """ Check the version of the catalog at the next cached request, after a committed write of the restaurants """
+    if session.info.pop("catalog_changed", False):
+        search_cache.expire_version()
+
+event.listen(db.session, "after_commit", catalog_committed)
+event.listen(db.session, "after_rollback", lambda session: session.info.pop("catalog_changed", None))
+
+def check_not_modified(model, record_id):
+    """ Return the 304 response to a conditional request if the record did not change, None otherwise
+
+    Only the version of the record is read, when the records are not in the entity cache
+    (otherwise the version is read from the cache)
+    """
+    if entity_cache.enabled or not request.if_none_match:
+        return None
+    version = load_version(model, record_id)
+    if version is None:
+        return None
+    return not_modified(make_etag(version))
+
+@cached
+def get_restaurants(name=None, opening_time=None, open_day=None, cuisine_type=None, menu=None, near=None, radius_km=None, sort=None, limit=None, cursor=None, fields=None):
     """ Return the list of restaurants.
 
-    GET /restaurants?[name=N_ID&][opening_time=TIME_ID&][open_day=DAY_ID&][cuisine_type=CUISINE_DT&][menu=MENU_DT&]
+    GET /restaurants?[name=N_ID&][opening_time=TIME_ID&][open_day=DAY_ID&][cuisine_type=CUISINE_DT&][menu=MENU_DT&][near=LAT,LON&radius_km=KM&][sort=SORT&][limit=LIMIT&][cursor=CURSOR&][fields=F1,F2..&]
 
     It's possible to filter the restaurants thanks the query's parameters.
     The parameters can be overlapped in any way.
@@ -63,43 +179,132 @@ def get_restaurants(name=None, opening_time=None, open_day=None, cuisine_type=No
     - open_day: All restaurants that are open in that day
     - cuisine_type: All restaurants that match the cuisine type
     - menu: All restaurants that match the menu
+    - near, radius_km: All restaurants within radius_km from the point near ("lat,lon"), 
+        the distance (in km) is added to the results
+    - sort: "id" (default), "relevance" (best text matches first) or "distance" (nearest first, requires near)
+    - limit: the maximum number of restaurants returned (PAGE_SIZE by default, 0 for all of them)
+    - cursor: return the page after the one that gave this cursor
+    - fields: return only these fields (only the needed columns are read from the database)
+
+    name, cuisine_type and menu are matched word by word (as prefixes) through the full-text index.
+
+    The whole list is returned only when it is asked for (limit=0).
+    The pages are selected by keyset (the sort key of the last restaurant is stored in the cursor),
+    so a page costs the same whatever its depth.
+    If there are more restaurants a Link header (rel="next") points to the next page.
+
+    The page has an ETag (see utils.collection_etag), if it matches If-None-Match a 304 is returned.
 
     Status Codes:
         200 - OK
-        400 - Something wrong in the openings
+        304 - Not modified
+        400 - Something wrong in the openings, in the position or in the cursor
     """
 
-    q = db.session.query(Restaurant)
-    if name is not None:
-        q = q.filter(Restaurant.name.contains(name))
-    if opening_time is not None:
-        if opening_time >= 0 and opening_time <= 23:
-            q = q.filter(
-                    (Restaurant.first_opening_hour.isnot(None) & Restaurant.first_closing_hour.isnot(None) & 
-                        (Restaurant.first_opening_hour <= opening_time)
-                        &
-                        (opening_time <= Restaurant.first_closing_hour)
-                    )
-                    |
-                    (Restaurant.second_opening_hour.isnot(None) & Restaurant.second_closing_hour.isnot(None) & 
-                        (Restaurant.second_opening_hour <= opening_time)
-                        &
-                        (opening_time <= Restaurant.second_closing_hour)
-                    )
-                )
-        else:
-            return Error400("Argument: opening_time is not a valid hour").get()
-    if open_day is not None:
-        if open_day >= 1 and open_day <= 7:
-            q = q.filter(~Restaurant.closed_days.contains(str(open_day)))
-        else:
-            return Error400("Argument: open_day is not a valid day").get()
-    if cuisine_type is not None:
-        q = q.filter(Restaurant.cuisine_type.contains(cuisine_type))
-    if menu is not None:
-        q = q.filter(Restaurant.menu.contains(menu))
+    if opening_time is not None and not (opening_time >= 0 and opening_time <= 23):
+        return Error400("Argument: opening_time is not a valid hour").get()
+    if open_day is not None and not (open_day >= 1 and open_day <= 7):
+        return Error400("Argument: open_day is not a valid day").get()
+
+    center = None
+    if near is not None:
+        center = parse_point(near)
+        if center is None:
+            return Error400("Argument: near is not a valid position (lat,lon)").get()
+        if radius_km is None:
+            return Error400("Argument: near requires radius_km").get()
+    elif radius_km is not None:
+        return Error400("Argument: radius_km requires near").get()
+    elif sort == "distance":
+        return Error400("Argument: sort by distance requires near").get()
+
+    if limit is None:
+        limit = current_app.config["PAGE_SIZE"]
+    elif limit == 0: # the whole list
+        limit = None
+    fetch = None if limit is None else limit+1 # one more restaurant tells if there is a next page
+
+    serialize = Restaurant.serializer(fields)
+    q = db.session.query(*serialize.columns) # only the needed columns are read, no ORM instances are built
+    if center is not None:
+        q = q.add_columns(Restaurant.lat, Restaurant.lon)
+    q = q.add_columns(Restaurant.version)
+    q = opening_search(q, opening_time, open_day)
+
+    filters = {"name": name, "cuisine_type": cuisine_type, "menu": menu}
+    q,indexed = text_search(q, filters, current_app.config["USE_FTS"])
+
+    keys = [Restaurant.id] # the sort keys (the last one is unique)
+    if sort == "relevance" and indexed:
+        keys = [restaurant_fts.c.rank, Restaurant.id]
+    q = q.order_by(*keys).add_columns(*keys)
+
+    values = None
+    if cursor is not None:
+        values = decode_cursor(cursor, 2 if sort == "distance" else len(keys)) # by distance the keys are (distance, id)
+        if values is None:
+            return Error400("Argument: cursor is not valid").get()
+
+    if center is None:
+        if values is not None:
+            q = keyset_filter(q, keys, values)
+        found = [(row, None) for row in q.limit(fetch)]
+    elif sort == "distance": # the keys are (distance, id), computed by the query
+        found = geo_search(q, center[0], center[1], radius_km, current_app.config["USE_RTREE"], True, fetch, values)
+    else:
+        if values is not None:
+            q = keyset_filter(q, keys, values)
+        found = geo_search(q, center[0], center[1], radius_km, current_app.config["USE_RTREE"], False, fetch)
+
+    more = limit is not None and len(found) > limit
+    etag = collection_etag([row for row,distance in found[:limit]], more)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    ret = []
+    for row,distance in found[:limit]:
+        d = serialize(row)
+        if distance is not None and (fields is None or "distance" in fields):
+            d["distance"] = distance
+        ret.append(d)
+
+    headers = etag_header(etag)
+    if more:
+        row,distance = found[limit-1]
+        last = [distance, row.id] if sort == "distance" else list(row[-len(keys):])
+        headers.update(next_link(encode_cursor(last)))
+    return json_response(ret, 200, headers)
+
+def export_restaurants():
+    """ Stream the whole catalog, one restaurant (json) per line.
+
+    GET /restaurants/export
+
+    The restaurants are read by chunks of EXPORT_CHUNK (by id, like the pages of get_restaurants)
+    and written as soon as they are read, so the memory used does not depend on the size of the catalog.
+    Every chunk is a short query: the database is not kept locked for the whole export.
 
-    return [p.dump() for p in q], 200
+    Status Codes:
+        200 - OK
+    """
+    chunk = current_app.config["EXPORT_CHUNK"]
+    serialize = Restaurant.serializer()
+
+    def generate():
+        last = None
+        while True:
+            q = db.session.query(*serialize.columns).order_by(Restaurant.id)
+            if last is not None:
+                q = keyset_filter(q, [Restaurant.id], [last])
+            rows = q.limit(chunk).all()
+            for row in rows:
+                yield dumps(serialize(row)) + "\n"
+            if len(rows) < chunk:
+                break
+            last = rows[-1].id
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 def post_restaurants():
     """ Add a new restaurant.
@@ -135,25 +340,47 @@ def post_restaurants():
 
     rest_id = add_restaurant(req)
 
-    restaurant, status_code = get_restaurant(rest_id)
+    restaurant, status_code = get_restaurant(rest_id)[:2]
     if status_code == 200:
         return restaurant, 201
     else: # unexpected error
         return Error500().get()
 
-def get_restaurant(restaurant_id):
+@cached
+def get_restaurant(restaurant_id, fields=None):
     """ Return a specific restaurant (request by id)
 
-    GET /restaurants/{restaurant_id}
+    GET /restaurants/{restaurant_id}?[fields=F1,F2..]
+
+    If fields is given only those fields are returned
+
+    The restaurant is read through the entity cache, if enabled.
+    Its ETag is its version, if it matches If-None-Match a 304 is returned.
 
         Status Codes:
             200 - OK
+            304 - Not modified
             404 - Restaurant not found
     """
-    q = db.session.query(Restaurant).filter_by(id = restaurant_id).first()
+    response = check_not_modified(Restaurant, restaurant_id)
+    if response is not None:
+        return response
+
+    if fields is not None and not entity_cache.enabled:
+        q = load_restaurant(restaurant_id, fields) # only the requested columns are read
+    else:
+        q = entity_cache.get("restaurant", restaurant_id, lambda: load_restaurant(restaurant_id))
     if q is None:
         return Error404("Restaurant not found").get()
-    return q.dump(), 200
+
+    version,rest = q
+    etag = make_etag(version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    if fields is not None:
+        rest = dict([(k,v) for k,v in rest.items() if k in fields])
+    return rest, 200, etag_header(etag)
 
 def put_restaurant(restaurant_id):
     """ Return a specific restaurant (request by id)
@@ -188,7 +415,7 @@ def put_restaurant(restaurant_id):
 
     rest_id = edit_restaurant(restaurant_id, req)
 
-    restaurant, status_code = get_restaurant(rest_id)
+    restaurant, status_code = get_restaurant(rest_id)[:2]
     if status_code == 200:
         return restaurant, 200
     else: # unexpected error
@@ -225,19 +452,38 @@ def delete_restaurant(restaurant_id):
 
     return NoContent, 204
 
-def get_restaurant_rating(restaurant_id):
+def get_restaurant_rating(restaurant_id, detail=None):
     """ Return the rating of a specific restaurant (request by id)
 
-    GET /restaurants/{restaurant_id}/rate
+    GET /restaurants/{restaurant_id}/rate?[detail=histogram]
+
+    With detail=histogram the number of ratings of each value is returned too
+    (histogram[v] is the number of ratings v, kept up to date with the rating by the worker).
+
+    Its ETag is the version of the restaurant, if it matches If-None-Match a 304 is returned.
 
         Status Codes:
             200 - OK
+            304 - Not modified
             404 - Restaurant not found
     """
-    q = db.session.query(Restaurant).filter_by(id = restaurant_id).first()
+    response = check_not_modified(Restaurant, restaurant_id)
+    if response is not None:
+        return response
+
+    q = entity_cache.get("restaurant", restaurant_id, lambda: load_restaurant(restaurant_id))
     if q is None:
         return Error404("Restaurant not found").get()
-    return q.dump_rating(), 200
+
+    version,rest = q
+    etag = make_etag(version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    rating = {"rating": rest["rating_val"], "ratings": rest["rating_num"]}
+    if detail == "histogram":
+        rating["histogram"] = load_rating_histogram(restaurant_id)
+    return rating, 200, etag_header(etag)
 
 def post_restaurant_rating(restaurant_id):
     """ Add a new rating for the restaurant.
@@ -250,6 +496,12 @@ def post_restaurant_rating(restaurant_id):
         - rater_id
         - rating
 
+    In write-behind mode (RATINGS_QUEUE_URL) the rating is only queued, it is inserted later by the worker
+    (see ratings.RatingQueue): a duplicate still in the queue is accepted and then ignored.
+
+    With the rating events (RATINGS_EVENTS_URL) the update of the rating of the restaurant is scheduled
+    (see background.schedule_rating_update), in write-behind mode once the rating is inserted (see background.flush_ratings).
+
     Status Codes:
         202 - The ratingg for the restaurant has been created
         400 - Bad request or Restaurant already rated by the user
@@ -261,40 +513,75 @@ def post_restaurant_rating(restaurant_id):
     if err is not None:
         return err
 
-    code = add_rating(req, restaurant_id)
+    if rating_queue.enabled and rating_queue.push(restaurant_id, req["rater_id"], req["rating"]):
+        rated_filter.add(restaurant_id, req["rater_id"])
+        return NoContent, 202
+
+    code = add_rating(req, restaurant_id) # no queue or redis not reachable
     if code is None:
-        return Error500().get()
+        return valid_rating(req, restaurant_id, use_filter=False) or Error500().get() # added meanwhile by another process
+    rated_filter.add(restaurant_id, req["rater_id"])
+    if rating_events.enabled:
+        schedule_rating_update(restaurant_id)
 
     if valid_rating(req, restaurant_id) is not None:
         return NoContent, 202
     else: # unexpected error
         return Error500().get()
 
-def get_restaurant_tables(restaurant_id, capacity=None):
+def get_restaurant_tables(restaurant_id, capacity=None, limit=None, cursor=None):
     """ Return the tables of a restaurant (request by id)
 
-    GET /restaurants/{restaurant_id}/tables?capacity=CAPACITY
+    GET /restaurants/{restaurant_id}/tables?[capacity=CAPACITY&][limit=LIMIT&][cursor=CURSOR&]
     
     capacity is optional and specify the minimum capacity the returned tables should have
 
+    The tables are paginated by id like the restaurants (see get_restaurants),
+    PAGE_SIZE by default and all of them with limit=0. The page has an ETag like them.
+
         Status Codes:
             200 - OK
             204 - No tables with such capacity or no tables
+            304 - Not modified
+            400 - The cursor is not valid
             404 - Restaurant not found
     """
     q = db.session.query(Restaurant).filter(Restaurant.id == restaurant_id)
     if q is None:
         return Error404("Restaurant not found").get()
 
-    q = db.session.query(Table).filter(Table.restaurant_id == restaurant_id)
+    if limit is None:
+        limit = current_app.config["PAGE_SIZE"]
+    elif limit == 0: # the whole list
+        limit = None
+
+    serialize = Table.serializer()
+    q = db.session.query(*serialize.columns, Table.version).filter(Table.restaurant_id == restaurant_id)
     if capacity is not None:
         q = q.filter(Table.capacity >= capacity)
+    q = q.order_by(Table.id)
+
+    if cursor is not None:
+        values = decode_cursor(cursor, 1)
+        if values is None:
+            return Error400("Argument: cursor is not valid").get()
+        q = keyset_filter(q, [Table.id], values)
 
-    q = q.all()
+    q = q.limit(None if limit is None else limit+1).all()
 
     if len(q)==0:
         return NoContent, 204
-    return [q.dump() for q in q], 200
+
+    more = limit is not None and len(q) > limit
+    etag = collection_etag(q[:limit], more)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+
+    headers = etag_header(etag)
+    if more:
+        headers.update(next_link(encode_cursor([q[limit-1].id])))
+    return json_response([serialize(row) for row in q[:limit]], 200, headers)
 
 def post_restaurant_table(restaurant_id):
     """ Add a new table for the restaurant.
@@ -321,7 +608,7 @@ def post_restaurant_table(restaurant_id):
 
     table_id = add_table(req, restaurant_id)
 
-    table, status_code = get_restaurant_table(restaurant_id, table_id)
+    table, status_code = get_restaurant_table(restaurant_id, table_id)[:2]
     if status_code == 200:
         return table, 201
     else: # unexpected error
@@ -332,16 +619,29 @@ def get_restaurant_table(restaurant_id, table_id):
 
     GET /restaurants/{restaurant_id}/tables/{table_id}
 
+    Its ETag is its version, if it matches If-None-Match a 304 is returned.
+
         Status Codes:
             200 - OK
+            304 - Not modified
             400 - Data error
             404 - Restaurant or Table not found
             500 - DB error
     """
-    q = db.session.query(Table).filter(Table.id == table_id and Table.restaurant_id == restaurant_id).first()
+    response = check_not_modified(Table, table_id)
+    if response is not None:
+        return response
+
+    q = entity_cache.get("table", table_id, lambda: load_table(table_id))
     if q is None:
         return Error404("Restaurant or Table not found").get()
-    return q.dump(), 200
+
+    version,table = q
+    etag = make_etag(version)
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    return table, 200, etag_header(etag)
 
 def put_restaurant_table(restaurant_id, table_id):
     """ Return a specific restaurant (request by id)
@@ -372,7 +672,7 @@ def put_restaurant_table(restaurant_id, table_id):
     if table_id != table_id2:
         return Error500().get()
 
-    restaurant, status_code = get_restaurant_table(restaurant_id, table_id)
+    restaurant, status_code = get_restaurant_table(restaurant_id, table_id)[:2]
     if status_code == 200:
         return restaurant, 200
     else: # unexpected error
@@ -410,6 +710,48 @@ def delete_restaurant_table(restaurant_id, table_id):
     return NoContent, 204
 
 
+def post_bookings_changed(restaurant_id, table=None):
+    """ Notify that the bookings of a restaurant (of one of its tables, if given) changed, called by the bookings service
+
+    POST /restaurants/{restaurant_id}/bookings/changed?[table=T]
+
+    Their future bookings are dropped from the bookings cache of all the processes,
+    so the next checks of the conflicts read them again.
+
+        Status Codes:
+            204 - Dropped
+    """
+    bookings_cache.invalidate(restaurant_id, table)
+    return NoContent, 204
+
+def get_stats():
+    """ Return the counters of the service (for monitoring)
+
+    GET /stats
+
+        Status Codes:
+            200 - OK
+    """
+    return {"search_cache": search_cache.stats(), "entity_cache": entity_cache.stats(), "rating_queue": rating_queue.stats(),
+        "rated_filter": rated_filter.stats(), "rating_events": rating_events.stats(), "scheduler": scheduler.stats(),
+        "http_client": http_client.stats(), "bookings_breaker": bookings_breaker.stats(),
+        "bookings_cache": bookings_cache.stats()}, 200
+
+def check_deadline():
+    """ Read the deadline of the request (X-Request-Deadline or grpc-timeout, see utils.parse_deadline), run before every request
+
+    The requests whose deadline already expired are answered at once with a 504,
+    the others carry it to the calls to the other services (see utils.get_from).
+    """
+    deadline = parse_deadline(request.headers)
+    request.environ[DEADLINE] = deadline
+    if deadline is not None and deadline <= time.monotonic():
+        return Error504().get()
+
+def deadline_exceeded(error):
+    """ Answer the requests whose deadline expired while calling another service (utils.DeadlineExceeded) """
+    return Error504().get()
+
 def get_config(configuration=None):
     """ Returns a json file containing the configuration to use in the app
 
@@ -481,14 +823,40 @@ def setup(application, config):
     if config["DB_DROPALL"]: #remove the data in the db
         logging.info("- GoOutSafe:Restaurants Dropping All from Database...")
         db.drop_all(app=application)
+        drop_search_index()
 
     db.create_all(app=application)
+    add_missing_columns(Table)
+    add_missing_columns(Rating)
+    init_opening_index()
+    init_catalog()
+    if init_rating_aggregates() > 0:
+        logging.info("- GoOutSafe:Restaurants Rating Sums Backfilled")
+
+    search_cache.configure(config["CACHE_SIZE"], config["CACHE_TTL"], config["CACHE_VERSION_INTERVAL"])
+    entity_cache.configure(redis_client(config["ENTITY_CACHE_URL"]), config["ENTITY_CACHE_TTL"])
+    rating_queue.configure(redis_client(config["RATINGS_QUEUE_URL"]))
+    rating_events.configure(redis_client(config["RATINGS_EVENTS_URL"]), config["RATINGS_DEBOUNCE"])
+    http_client.configure(config["HTTP_POOL_SIZE"], config["HTTP_RETRIES"], config["HTTP_RETRY_BACKOFF"], config["LATENCY_WINDOW"],
+        config["TIMEOUT_PERCENTILE"], config["TIMEOUT_MULTIPLIER"], config["TIMEOUT_MIN"], config["HEDGE_PERCENTILE"],
+        config["HEDGE_BUDGET"])
+    bookings_breaker.configure(config["BREAKER_FAILURES"], config["BREAKER_RESET"], config["BREAKER_TRIALS"])
+    bookings_cache.configure(config["BOOKINGS_CACHE_SIZE"], config["BOOKINGS_CACHE_TTL"], redis_client(config["BOOKINGS_CACHE_URL"]))
+
+    if application.config["USE_FTS"]:
+        application.config["USE_FTS"] = init_search_index()
+    if application.config["USE_RTREE"]:
+        application.config["USE_RTREE"] = init_geo_index()
 
     if config["FAKE_DATA"]: #add fake data (for testing)
         logging.info("- GoOutSafe:Restaurants Adding Fake Data...")
         with application.app_context():
             put_fake_data()
 
+    logging.info("- GoOutSafe:Restaurants Warming Rated Filter...")
+    rated_filter.configure(config["RATED_FILTER_CAPACITY"], config["RATED_FILTER_ERROR_RATE"], redis_client(config["RATED_FILTER_URL"]))
+    rated_filter.warm(lambda: itertools.chain(*[db.session.query(model.restaurant_id, model.rater_id).yield_per(10000) for model in [Rating, RatingArchive]]))
+
 def create_app(configuration=None):
     if configuration is None:
         configuration = os.getenv("CONFIG", "TEST")
@@ -499,6 +867,8 @@ def create_app(configuration=None):
     # set the WSGI application callable to allow using uWSGI:
     # uwsgi --http :8080 -w app
     application = app.app
+    application.before_request(check_deadline)
+    application.register_error_handler(DeadlineExceeded, deadline_exceeded)
 
     conf = get_config(configuration)
     logging.info(conf)
@@ -507,6 +877,9 @@ def create_app(configuration=None):
         setup(application, conf)
 
     init_celery(application)
+    if conf["SCHEDULER"]: # single node deployment, without the worker
+        logging.info("- GoOutSafe:Restaurants Starting the Scheduler...")
+        init_scheduler(application)
 
     return app
 
@@ -527,6 +900,10 @@ def create_worker_app():
     application.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + application.config["SQLALCHEMY_DATABASE_URI"]
     
     db.init_app(application)
+    entity_cache.configure(redis_client(conf["ENTITY_CACHE_URL"]), conf["ENTITY_CACHE_TTL"])
+    rating_queue.configure(redis_client(conf["RATINGS_QUEUE_URL"]))
+    rating_events.configure(redis_client(conf["RATINGS_EVENTS_URL"]), conf["RATINGS_DEBOUNCE"])
+    rated_filter.configure(conf["RATED_FILTER_CAPACITY"], conf["RATED_FILTER_ERROR_RATE"], redis_client(conf["RATED_FILTER_URL"])) # not warmed, it is not read by the worker
     init_celery(application)
 
     return application
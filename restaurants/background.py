@@ -1,63 +1,337 @@
-from celery import Celery
+from celery import Celery, chord
 from celery.schedules import crontab
-from restaurants.orm import db,Rating,Restaurant
+from restaurants.orm import db,Rating,RatingArchive,Restaurant,RATING_VALUES,fold_ratings,next_version,rating_counts,rating_histogram
+from sqlalchemy import and_, bindparam, func, or_, select, tuple_, union_all
+from restaurants.cache import entity_cache
+from restaurants.ratings import rating_events, rating_queue
+from restaurants.scheduler import scheduler
+from restaurants.utils import add_ratings
 from celery.utils.log import get_task_logger
 import datetime
+import time
 
 logger = get_task_logger(__name__)
 
 celery = Celery()
 _APP = None
 
-@celery.task
-def recompute_ratings():
+@celery.task(bind=True)
+def recompute_ratings(self):
     """ This task recompute all the rating for all the restaurants.
-        The other task has numerical instability so may report wrong ratings long time. """
+        The other task keeps exact sums (see orm.fold_ratings), so this is a consistency check:
+        only the restaurants whose sum or number differ are updated (they are counted as fixed).
+
+        The restaurants are independent, so the task is replaced by a chord: the ranges of RECOMPUTE_PARTITION
+        restaurant ids are recomputed in parallel by the workers (recompute_ratings_partition),
+        then recompute_ratings_done adds up their reports.
+        The ratings waiting in the write-behind queue are inserted first, the archived ratings are counted too.
+        Returns (and logs) the number of ratings and restaurants processed, of the fixed restaurants,
+        of the partitions and the elapsed seconds. """
     with _APP.app_context():
-        try:
-            ratings = db.session.query(Rating).filter().all() # All the ratings
-            rests_rating = {} # A dictionary containings for every restaurant the sum of the rating received and the number
-
-            for rate in ratings:
-                sum,num = rests_rating.get(rate.restaurant_id, (0,0))
-                rests_rating[rate.restaurant_id] = (sum+rate.rating, num+1)
-                rate.marked = True # This task still mark the ratings
-
-            for rest_id,(sum,num) in rests_rating.items():
-                rest = db.session.query(Restaurant).filter(Restaurant.id == rest_id).first()
-                rest.rating_val = sum/num # Mean rating for every restaurant
-                rest.rating_num = num
-        except: # pragma: no cover
-            traceback.print_exc()
-            logger.info("task-recompute-rollback")
-            db.session.rollback()
-            raise
-        else:
+        start = time.time() # the partitions may run in other processes
+        flush_rating_queue(_APP.config["RATINGS_BATCH"])
+        bounds = [db.session.query(func.min(model.restaurant_id), func.max(model.restaurant_id)).first() for model in [Rating, RatingArchive]]
+        db.session.rollback()
+        low = min([b[0] for b in bounds if b[0] is not None], default=None)
+        high = max([b[1] for b in bounds if b[1] is not None], default=None)
+        size = _APP.config["RECOMPUTE_PARTITION"]
+        partitions = [] if low is None else [recompute_ratings_partition.s(first, first + size) for first in range(low, high + 1, size)]
+        logger.info("task-recompute-start: %d partitions", len(partitions))
+    if self.request.is_eager: # apply(): the partitions run here, one after the other (a chord would wait on the result backend)
+        return recompute_ratings_done([partition.apply().get() for partition in partitions], start)
+    if len(partitions) == 0:
+        return recompute_ratings_done([], start)
+    return self.replace(chord(partitions, recompute_ratings_done.s(start)))
+
+@celery.task
+def recompute_ratings_partition(first, end):
+    """ This task recomputes the ratings of the restaurants with first <= id < end
+
+    The restaurants are recomputed in chunks of RECOMPUTE_CHUNK (by id), each one committed on its own
+    (see recompute_ratings_chunk), so the memory used does not depend on the number of ratings
+    and the database is never locked for long.
+    Returns the number of ratings and restaurants processed and of the fixed restaurants.
+    """
+    with _APP.app_context():
+        ratings = restaurants = fixed = 0
+        last = first - 1 # the last recomputed restaurant
+        while True:
+            try:
+                totals,changed = recompute_ratings_chunk(last, _APP.config["RECOMPUTE_CHUNK"], end)
+            except: # pragma: no cover
+                traceback.print_exc()
+                logger.info("task-recompute-rollback")
+                db.session.rollback()
+                raise
+            if len(totals) == 0:
+                break
             logger.info("task-recompute-commit")
-            db.session.commit()
+            for rest_id,total,num,*counts in totals:
+                ratings += num
+                entity_cache.invalidate("restaurant", rest_id)
+            restaurants += len(totals)
+            fixed += changed
+            last = totals[-1][0]
+        return {"ratings": ratings, "restaurants": restaurants, "fixed": fixed}
+
+@celery.task
+def recompute_ratings_done(reports, start):
+    """ The last step of recompute_ratings: adds up the reports of the partitions, logs and returns the total """
+    report = {"ratings": 0, "restaurants": 0, "fixed": 0}
+    for partition in reports:
+        for key in report:
+            report[key] += partition[key]
+    report["partitions"] = len(reports)
+    report["seconds"] = max(0, time.time() - start)
+    logger.info("task-recompute-done: %d ratings of %d restaurants (%d fixed) in %d partitions, %.3f seconds",
+        report["ratings"], report["restaurants"], report["fixed"], report["partitions"], report["seconds"])
+    return report
+
+def recompute_ratings_chunk(after, size, end=None):
+    """ Recompute the ratings of the first size restaurants (that have ratings) with id greater than after
+    (and less than end, if given) and mark them, in one transaction
+
+    The sum and the number of the ratings (and of the archived ones) of each restaurant are computed by the database
+    (GROUP BY, along the indexes on restaurant_id) and the restaurants are updated by one bulk statement.
+
+    Returns the list of (restaurant_id, sum, number, number of each value...) ordered by id, empty if there are no more restaurants,
+    and the number of updated restaurants (whose sum, number or histogram was wrong)
+    """
+    version = next_version() # locks the database until the commit (see check_ratings_batch)
+    parts = []
+    for model in [Rating, RatingArchive]:
+        chunk = model.restaurant_id > after
+        if end is not None:
+            chunk = and_(chunk, model.restaurant_id < end)
+        parts.append(select([model.restaurant_id, model.rating]).where(chunk))
+    ratings = union_all(*parts).alias("ratings")
+    totals = db.session.query(ratings.c.restaurant_id, func.sum(ratings.c.rating), func.count(), *rating_counts(ratings.c.rating)) \
+        .group_by(ratings.c.restaurant_id).order_by(ratings.c.restaurant_id).limit(size).all()
+    if len(totals) == 0:
+        db.session.rollback()
+        return totals,0
+
+    columns = [Restaurant.rating_sum, Restaurant.rating_num] + rating_histogram()
+    names = ["total", "num"] + ["n%d" % value for value in RATING_VALUES]
+    values = dict([(column.key, bindparam(name)) for column,name in zip(columns, names)])
+    changed = db.session.execute(
+        Restaurant.__table__.update().where(and_(Restaurant.id == bindparam("rest_id"),
+            or_(*[column.is_distinct_from(bindparam(name)) for column,name in zip(columns, names)]))).values(
+            rating_val = bindparam("val"),
+            version = version,
+            **values),
+        [dict([("rest_id", row[0]), ("val", row[1]/row[2])] + list(zip(names, row[1:]))) for row in totals]).rowcount # Mean rating for every restaurant
+    db.session.query(Rating).filter(Rating.restaurant_id > after, Rating.restaurant_id <= totals[-1][0], Rating.marked == False) \
+        .update({Rating.marked: True}, synchronize_session=False) # This task still mark the ratings
+    db.session.commit()
+    return totals,changed
+
 import traceback
 
 
 @celery.task
 def check_ratings():
-    """ This task compute the new mean rating for the restaurants that have unmarked ratings """
+    """ This task compute the new mean rating for the restaurants that have unmarked ratings
+
+    The ratings are counted in batches of RATINGS_BATCH, each one committed on its own (see check_ratings_batch),
+    so the database is never locked for long.
+    The ratings waiting in the write-behind queue are inserted first.
+    With the rating events (see schedule_rating_update) it only catches the updates that have been lost.
+    Returns the number of counted ratings.
+    """
     with _APP.app_context():
+        flush_rating_queue(_APP.config["RATINGS_BATCH"])
+        return count_ratings()
+
+@celery.task
+def update_restaurant_rating(restaurant_id):
+    """ This task compute the new mean rating of a restaurant, scheduled by its new ratings (see schedule_rating_update)
+
+    Returns the number of counted ratings.
+    """
+    with _APP.app_context():
+        rating_events.release(restaurant_id) # the ratings arriving from now on schedule a new update
+        return count_ratings(restaurant_id)
+
+def schedule_rating_update(restaurant_id):
+    """ Schedule the update of the rating of a restaurant after a new rating, unless it is already scheduled
+
+    The update runs after RATINGS_DEBOUNCE seconds: all the ratings of the restaurant arriving meanwhile
+    are counted by the same update (see ratings.RatingEvents).
+    The task is published without retries: if the broker cannot be reached the request does not wait for it.
+    Returns True if the update has been scheduled
+    """
+    if not rating_events.claim(restaurant_id):
+        return False
+    try:
+        update_restaurant_rating.apply_async((restaurant_id,), countdown=rating_events.debounce, retry=False)
+    except Exception as e: # the broker cannot be reached, the ratings are counted by check_ratings
+        logger.info("task-update_restaurant_rating-not-scheduled: %s", e)
+        rating_events.release(restaurant_id)
+        return False
+    return True
+
+def count_ratings(restaurant_id=None):
+    """ Count the unmarked ratings (of a restaurant, if given) in batches of RATINGS_BATCH, each one committed on its own
+
+    Returns the number of counted ratings.
+    """
+    counted = 0
+    while True:
         try:
-            ratings = db.session.query(Rating).filter(Rating.marked == False).all()
-            for rate in ratings:
-                val = rate.restaurant.rating_val
-                num = rate.restaurant.rating_num
-                rate.restaurant.rating_val = (val*num + rate.rating) / (num+1)
-                rate.restaurant.rating_num += 1
-                rate.marked = True
+            totals = check_ratings_batch(_APP.config["RATINGS_BATCH"], restaurant_id)
         except:
             traceback.print_exc()
             logger.info("task-check_ratings-rollback")
             db.session.rollback()
             raise
-        else:
-            logger.info("task-check_ratings-commit")
-            db.session.commit()
+        if totals is None: # no more unmarked ratings
+            return counted
+        logger.info("task-check_ratings-commit")
+        for rest_id,total,num,*counts in totals:
+            counted += num
+            entity_cache.invalidate("restaurant", rest_id)
+
+def check_ratings_batch(size, restaurant_id=None):
+    """ Count up to size unmarked ratings (of a restaurant, if given) in the means of their restaurants and mark them, in one transaction
+
+    The work is set based: the sum and the number of the ratings of each restaurant are computed
+    by the database (GROUP BY), the restaurants are updated by one bulk statement and the ratings
+    are marked by another one, whatever the number of ratings no record is loaded one by one.
+
+    The histograms of the restaurants are updated by the same statement (see orm.rating_histogram).
+
+    Returns the list of (restaurant_id, sum, number, number of each value...) of the counted ratings, None if there are no unmarked ratings
+    """
+    batch = Rating.marked == False
+    if restaurant_id is not None:
+        batch = and_(batch, Rating.restaurant_id == restaurant_id)
+    if db.session.query(Rating.rater_id).filter(batch).first() is None:
+        return None
+    # the first write of the transaction locks the database until the commit,
+    # so no rating can be added between the sums and the marking
+    version = next_version()
+
+    # the batch is the first size unmarked ratings by key
+    key = [Rating.rater_id, Rating.restaurant_id]
+    last = db.session.query(*key).filter(batch).order_by(*key).offset(size-1).limit(1).first()
+    if last is not None:
+        batch = and_(batch, tuple_(*key) <= tuple_(*last))
+
+    totals = db.session.query(Rating.restaurant_id, func.sum(Rating.rating), func.count(), *rating_counts()).filter(batch) \
+        .group_by(Rating.restaurant_id).all()
+    counts = ["n%d" % value for value in RATING_VALUES]
+    db.session.execute(
+        Restaurant.__table__.update().where(Restaurant.id == bindparam("rest_id")).values(
+            version = version, **fold_ratings(bindparam("total"), bindparam("num"), [bindparam(n) for n in counts])),
+        [dict([("rest_id", row[0]), ("total", row[1]), ("num", row[2])] + list(zip(counts, row[3:]))) for row in totals])
+    db.session.query(Rating).filter(batch).update({Rating.marked: True}, synchronize_session=False)
+    db.session.commit()
+    return totals
+
+@celery.task
+def flush_ratings():
+    """ This task inserts the ratings accepted in write-behind mode (see ratings.RatingQueue)
+
+    With the rating events the updates of the restaurants of the inserted ratings are scheduled
+    (see schedule_rating_update): in write-behind mode the new ratings are counted once inserted.
+    Returns the number of inserted ratings.
+    """
+    with _APP.app_context():
+        return flush_rating_queue(_APP.config["RATINGS_BATCH"], rating_events.enabled)
+
+def flush_rating_queue(size, schedule=False):
+    """ Insert the queued ratings in batches of size, each one with a single multi-row INSERT (see utils.add_ratings)
+
+    The batches are claimed atomically (see ratings.RatingQueue.claim), so the flushes can run at the same time.
+    A batch is removed only once inserted: on errors it is given back to the queue for the next flush.
+    The batches of the flushes that died are given back first.
+    If schedule, the updates of the restaurants of the inserted ratings are scheduled.
+    Returns the number of inserted ratings (the duplicates are not counted)
+    """
+    if not rating_queue.enabled:
+        return 0
+    rating_queue.requeue_expired()
+    inserted = 0
+    while True:
+        batch,ratings = rating_queue.claim(size)
+        if len(ratings) == 0:
+            rating_queue.ack(batch, 0)
+            break
+        count = add_ratings(ratings)
+        if count is None:
+            logger.info("task-flush_ratings-rollback")
+            rating_queue.release(batch)
+            break
+        logger.info("task-flush_ratings-commit")
+        rating_queue.ack(batch, len(ratings))
+        inserted += count
+        if schedule and count > 0:
+            for restaurant_id in set([rating[0] for rating in ratings]):
+                schedule_rating_update(restaurant_id)
+    return inserted
+
+@celery.task
+def archive_ratings():
+    """ This task moves the counted ratings older than RATINGS_ARCHIVE_AFTER days to the archive (see orm.RatingArchive)
+
+    Rating keeps only the recent ratings, so its scans and its indexes do not grow with the history.
+    The ratings are moved in batches of RATINGS_BATCH, each one committed on its own (see archive_ratings_batch).
+    Returns the number of archived ratings.
+    """
+    with _APP.app_context():
+        horizon = datetime.datetime.utcnow() - datetime.timedelta(days=_APP.config["RATINGS_ARCHIVE_AFTER"])
+        archived = 0
+        while True:
+            try:
+                count = archive_ratings_batch(horizon, _APP.config["RATINGS_BATCH"])
+            except: # pragma: no cover
+                traceback.print_exc()
+                logger.info("task-archive_ratings-rollback")
+                db.session.rollback()
+                raise
+            if count == 0:
+                break
+            logger.info("task-archive_ratings-commit")
+            archived += count
+        logger.info("task-archive_ratings-done: %d ratings", archived)
+        return archived
+
+def archive_ratings_batch(horizon, size):
+    """ Move the first size (by key) marked ratings added before horizon (or before Rating.created existed) to the archive, in one transaction
+
+    The marked ratings never change, and they are copied and deleted in the same transaction:
+    a rating is always in one of the tables (the duplicates are checked in both).
+    Returns the number of archived ratings
+    """
+    batch = and_(Rating.marked == True, or_(Rating.created == None, Rating.created < horizon))
+    key = [Rating.rater_id, Rating.restaurant_id]
+    last = db.session.query(*key).filter(batch).order_by(*key).offset(size-1).limit(1).first()
+    if last is not None:
+        batch = and_(batch, tuple_(*key) <= tuple_(*last))
+    columns = ["rater_id", "restaurant_id", "rating", "created"]
+    db.session.execute(RatingArchive.__table__.insert().prefix_with("OR IGNORE").from_select(columns,
+        select([getattr(Rating, name) for name in columns]).where(batch)))
+    count = db.session.query(Rating).filter(batch).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def init_scheduler(app):
+    """ Run the periodic tasks of the worker (see worker.py) in the embedded scheduler of this process (see scheduler.py)
+
+    The tasks are applied locally: the chord of recompute_ratings runs its partitions one after the other.
+    init_celery must be called first (the tasks use its app).
+    """
+    config = app.config
+    scheduler.configure(config["SCHEDULER_LOCK"], config["SCHEDULER_JITTER"])
+    scheduler.add("check_ratings", float(config["COMMIT_RATINGS_AFTER"]), lambda: check_ratings.apply().get())
+    if config["RATINGS_QUEUE_URL"]: # write-behind mode
+        scheduler.add("flush_ratings", float(config["FLUSH_RATINGS_AFTER"]), lambda: flush_ratings.apply().get())
+    if config["ARCHIVE_RATINGS"]:
+        scheduler.add("archive_ratings", 24 * 3600, lambda: archive_ratings.apply().get())
+    if config["RECOMPUTE_RATINGS"]:
+        scheduler.add("recompute_ratings", 7 * 24 * 3600, lambda: recompute_ratings.apply().get())
+    scheduler.start()
 
 def init_celery(app, worker=False):
     #print(app.config,flush=True)
@@ -0,0 +1,501 @@
+""" Caches of the restaurants service
+
+The search cache keeps the responses of GET /restaurants and GET /restaurants/{id}
+(see app.cached). Its entries are valid for a version of the catalog:
+the version is stored in the database (orm.Catalog) and bumped by every write
+on the restaurants, including the rating tasks of the worker, so all the
+processes see the changes. It is read at most every version_interval seconds
+(and at once after a write of the process), not by every request.
+
+The entity cache keeps the serialized restaurants and tables in redis,
+shared by all the processes (see EntityCache).
+
+The bookings cache keeps the future bookings read from the bookings service for a few seconds,
+until the bookings service notifies a change (see BookingsCache).
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """ A bounded cache (the least recently used entries are evicted first) whose entries expire after ttl seconds
+
+    It is thread safe and counts hits, misses, evictions and invalidations
+    """
+    def __init__(self, capacity=1024, ttl=60):
+        self.lock = threading.Lock()
+        self.configure(capacity, ttl)
+
+    def configure(self, capacity, ttl, version_interval=0):
+        """ Set the capacity (0 disables the cache), the ttl and the seconds between the version checks, the cache is emptied """
+        with self.lock:
+            self.capacity = capacity
+            self.ttl = ttl
+            self.version_interval = version_interval
+            self.entries = OrderedDict() # key -> (expiration time, value)
+            self.version = None
+            self.version_checked = None # time of the last version check
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.invalidations = 0
+
+    def check_version(self, load):
+        """ Empty the cache if the data changed version since the entries were stored
+
+        load returns the current version, it is called at most every version_interval seconds (see expire_version)
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.version_checked is not None and now - self.version_checked < self.version_interval:
+                return
+        version = load()
+        with self.lock:
+            self.version_checked = now
+            if version != self.version:
+                if len(self.entries) > 0:
+                    self.invalidations += 1
+                self.entries.clear()
+                self.version = version
+
+    def expire_version(self):
+        """ Check the version at the next check_version (the data was written by this process) """
+        with self.lock:
+            self.version_checked = None
+
+    def get(self, key):
+        """ Returns the pair (True, value) if the key is in the cache, (False, None) otherwise """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            if entry is not None: # expired
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            if self.capacity <= 0:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_where(self, test):
+        """ Delete the entries whose key passes test, returns their number """
+        with self.lock:
+            keys = [key for key in self.entries if test(key)]
+            for key in keys:
+                del self.entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """ Return the counters of the cache as a dict """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+class MemoryRedis:
+    """ A local in-memory stand-in of the redis client (only the commands used by EntityCache and ratings)
+
+    Used by the tests and by single process deployments (ENTITY_CACHE_URL = memory://),
+    the published messages are delivered synchronously to the handlers.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {} # key -> (expiration time or None, value)
+        self.lists = {} # key -> list of values
+        self.zsets = {} # key -> {member: score}
+        self.bitmaps = {} # key -> bytearray (bit 0 is the highest of the first byte, like redis)
+        self.handlers = {} # channel -> handlers
+
+    def get(self, key):
+        with self.lock:
+            if key in self.bitmaps:
+                return bytes(self.bitmaps[key])
+            entry = self.data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] <= time.monotonic()):
+                return None
+            return entry[1]
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            entry = self.data.get(key)
+            if nx and entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                return None
+            self.bitmaps.pop(key, None)
+            self.data[key] = (None if ex is None else time.monotonic() + ex, value if isinstance(value, bytes) else value.encode())
+        return True
+
+    def exists(self, *keys):
+        return len([key for key in keys if self.get(key) is not None or key in self.bitmaps])
+
+    def setbit(self, key, offset, value):
+        with self.lock:
+            bits = self.bitmaps.setdefault(key, bytearray())
+            if len(bits) <= offset >> 3:
+                bits.extend(bytes((offset >> 3) + 1 - len(bits)))
+            old = (bits[offset >> 3] >> (7 - (offset & 7))) & 1
+            if value:
+                bits[offset >> 3] |= 1 << (7 - (offset & 7))
+            else:
+                bits[offset >> 3] &= ~(1 << (7 - (offset & 7)))
+            return old
+
+    def getbit(self, key, offset):
+        with self.lock:
+            bits = self.bitmaps.get(key, b"")
+            if len(bits) <= offset >> 3:
+                return 0
+            return (bits[offset >> 3] >> (7 - (offset & 7))) & 1
+
+    def bitop(self, operation, destination, *keys):
+        assert operation == "OR"
+        values = [self.get(key) or b"" for key in keys]
+        result = bytearray(max([len(value) for value in values]))
+        for value in values:
+            for i,byte in enumerate(value):
+                result[i] |= byte
+        with self.lock:
+            self.data.pop(destination, None)
+            self.bitmaps[destination] = result
+        return len(result)
+
+    def pipeline(self):
+        return _MemoryPipeline(self)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            value = int(entry[1]) + 1 if entry is not None else 1
+            self.data[key] = (None if entry is None else entry[0], str(value).encode())
+            return value
+
+    def delete(self, *keys):
+        with self.lock:
+            return len([key for key in keys if self.data.pop(key, None) is not None or self.lists.pop(key, None) is not None
+                or self.bitmaps.pop(key, None) is not None])
+
+    def rpush(self, key, *values):
+        with self.lock:
+            items = self.lists.setdefault(key, [])
+            items.extend([value.encode() for value in values])
+            return len(items)
+
+    def lrange(self, key, start, end):
+        with self.lock:
+            items = self.lists.get(key, [])
+            return items[start:] if end == -1 else items[start:end+1]
+
+    def ltrim(self, key, start, end):
+        with self.lock:
+            items = self.lists.get(key, [])
+            self.lists[key] = items[start:] if end == -1 else items[start:end+1]
+            return True
+
+    def llen(self, key):
+        with self.lock:
+            return len(self.lists.get(key, []))
+
+    def lmove(self, source, destination, wherefrom, whereto):
+        with self.lock:
+            items = self.lists.get(source)
+            if not items:
+                return None
+            value = items.pop(0 if wherefrom == "LEFT" else -1)
+            if len(items) == 0:
+                del self.lists[source]
+            target = self.lists.setdefault(destination, [])
+            target.insert(0 if whereto == "LEFT" else len(target), value)
+            return value
+
+    def zadd(self, key, mapping):
+        with self.lock:
+            members = self.zsets.setdefault(key, {})
+            added = len([member for member in mapping if member not in members])
+            members.update(mapping)
+            return added
+
+    def zrem(self, key, *members):
+        with self.lock:
+            found = self.zsets.get(key, {})
+            return len([found.pop(member) for member in members if member in found])
+
+    def zrangebyscore(self, key, low, high):
+        with self.lock:
+            members = self.zsets.get(key, {})
+            return [member.encode() for member,score in sorted(members.items(), key=lambda item: item[1]) if low <= score <= high]
+
+    def publish(self, channel, message):
+        handlers = self.handlers.get(channel, [])
+        for handler in handlers:
+            handler({"type": "message", "channel": channel.encode(), "data": message.encode()})
+        return len(handlers)
+
+    def pubsub(self, **kwargs):
+        return _MemoryPubSub(self)
+
+class _MemoryPipeline:
+    """ Queues the commands, run by execute """
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        def command(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [method(*args, **kwargs) for method,args,kwargs in commands]
+
+class _MemoryPubSub:
+    def __init__(self, client):
+        self.client = client
+
+    def subscribe(self, **handlers):
+        for channel,handler in handlers.items():
+            self.client.handlers.setdefault(channel, []).append(handler)
+
+    def run_in_thread(self, **kwargs):
+        return None # the messages are delivered by publish
+
+def redis_client(url):
+    """ Return the client for the url (memory:// is the local stand-in), None if the url is empty """
+    if not url:
+        return None
+    if url.startswith("memory://"):
+        return MemoryRedis()
+    import redis
+    return redis.Redis.from_url(url)
+
+class EntityCache:
+    """ A read-through cache of serialized records (dicts), shared by all the processes through redis
+
+    The records are kept in redis (for ttl seconds) and in a small local cache of each process.
+    On writes the generation of the record is incremented in redis, the record is deleted from redis
+    and its key is published on CHANNEL, so every process drops it from its local cache at once.
+
+    A record is stored in redis along with the generation read before loading it, and it is found only
+    while the generation did not change: a loader that started before a write cannot store the old record
+    for the whole ttl. Likewise a process keeps a loaded record locally only if it saw no invalidation meanwhile.
+
+    If redis cannot be reached the records are read from the database (the loader).
+    Without a client the cache is disabled: the loader is always called.
+    """
+    CHANNEL = "restaurants:invalidate"
+    PREFIX = "restaurants:"
+
+    def __init__(self):
+        self.thread = None
+        self.configure(None)
+
+    def configure(self, client, ttl=300, local_size=1024):
+        if self.thread is not None: # stop listening to the previous client
+            self.thread.stop()
+            self.thread = None
+        self.client = client
+        self.ttl = ttl
+        self.local = LRUCache(local_size if client is not None else 0, ttl)
+        self.dropped = 0 # invalidations seen by this process
+        self.remote_hits = 0
+        self.loads = 0
+        self.errors = 0
+        if client is not None:
+            self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+            self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def _key(self, kind, id):
+        return "%s%s:%s" % (self.PREFIX, kind, id)
+
+    def _drop(self, key):
+        self.dropped += 1
+        self.local.delete(key)
+
+    def _on_invalidate(self, message):
+        key = message["data"]
+        self._drop(key.decode() if isinstance(key, bytes) else key)
+
+    def _put_local(self, key, value, dropped):
+        if self.dropped == dropped: # not invalidated while it was read
+            self.local.put(key, value)
+
+    def get(self, kind, id, loader):
+        """ Return the record kind/id, calling loader() (that returns the record or None) if it is not cached """
+        if self.client is None:
+            return loader()
+        key = self._key(kind, id)
+        found,value = self.local.get(key)
+        if found:
+            return value
+        dropped = self.dropped
+        try:
+            generation,data = self.client.mget([key + ":generation", key])
+            generation = int(generation or 0)
+            if data is not None:
+                stored,value = json.loads(data)
+                if stored == generation: # otherwise written by a loader that started before the last write
+                    self.remote_hits += 1
+                    self._put_local(key, value, dropped)
+                    return value
+        except Exception as e:
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants ENTITY CACHE ERROR: %s", e)
+            return loader()
+
+        self.loads += 1
+        value = loader()
+        if value is not None: # the missing records are not cached
+            self._put_local(key, value, dropped)
+            try:
+                self.client.set(key, json.dumps([generation, value]), ex=self.ttl)
+            except Exception as e:
+                self.errors += 1
+                logging.info("- GoOutSafe:Restaurants ENTITY CACHE ERROR: %s", e)
+        return value
+
+    def invalidate(self, kind, id):
+        """ Drop the record kind/id from redis and from the local caches of all the processes """
+        if self.client is None:
+            return
+        key = self._key(kind, id)
+        self._drop(key)
+        try:
+            pipe = self.client.pipeline()
+            pipe.incr(key + ":generation") # the records being loaded are stored with the previous one
+            pipe.delete(key)
+            pipe.publish(self.CHANNEL, key)
+            pipe.execute()
+        except Exception as e:
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants ENTITY CACHE ERROR: %s", e)
+
+    def stats(self):
+        """ Return the counters of the cache as a dict """
+        return {
+            "enabled": self.enabled,
+            "local": self.local.stats(),
+            "remote_hits": self.remote_hits,
+            "loads": self.loads,
+            "errors": self.errors,
+        }
+
+search_cache = LRUCache()
+entity_cache = EntityCache()
+
+class BookingsCache:
+    """ A short lived cache of the future bookings of the restaurants (and of their tables), read from the bookings service
+
+    The entries are kept in each process for ttl seconds, or until the bookings service notifies
+    that the bookings of the restaurant (or of one of its tables) changed (see invalidate):
+    then the entries of the restaurant and of the table are dropped.
+    The invalidations are published on CHANNEL of a redis client, so every process drops them.
+    Every invalidation increments the generation of the restaurant: the answers loaded while it changed
+    are returned but not kept (they may predate the change).
+    With size 0 or without a client the cache is disabled: the processes that did not receive the notification
+    would keep the changed bookings (memory:// is enough for a single process).
+    """
+    CHANNEL = "restaurants:bookings-invalidate"
+
+    def __init__(self):
+        self.thread = None
+        self.lock = threading.Lock()
+        self.configure(0)
+
+    def configure(self, size, ttl=5, client=None):
+        if self.thread is not None: # stop listening to the previous client
+            self.thread.stop()
+            self.thread = None
+        self.client = client
+        self.local = LRUCache(size if client is not None else 0, ttl)
+        self.generations = {} # restaurant_id -> number of invalidations
+        self.notified = 0
+        self.errors = 0
+        if client is not None and size > 0:
+            self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+            self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    @property
+    def enabled(self):
+        return self.local.capacity > 0
+
+    def get(self, restaurant_id, table_id, loader):
+        """ Return the pair (bookings, status code) of the restaurant/table, calling loader() if it is not cached
+
+        Only the successful answers (200) are cached.
+        """
+        found,value = self.local.get((restaurant_id, table_id))
+        if found:
+            return value
+        generation = self.generations.get(restaurant_id, 0)
+        value = loader()
+        with self.lock: # not invalidated while it was loaded
+            if value[1] == 200 and self.generations.get(restaurant_id, 0) == generation:
+                self.local.put((restaurant_id, table_id), value)
+        return value
+
+    def _drop(self, restaurant_id, table_id):
+        with self.lock:
+            self.generations[restaurant_id] = self.generations.get(restaurant_id, 0) + 1
+        if table_id is None: # all the tables of the restaurant
+            return self.local.delete_where(lambda key: key[0] == restaurant_id)
+        return self.local.delete_where(lambda key: key == (restaurant_id, None) or key == (restaurant_id, table_id))
+
+    def _on_invalidate(self, message):
+        data = message["data"]
+        restaurant_id,table_id = json.loads(data.decode() if isinstance(data, bytes) else data)
+        self._drop(restaurant_id, table_id)
+
+    def invalidate(self, restaurant_id, table_id=None):
+        """ Drop the bookings of the restaurant (of one of its tables, if given) from the caches of all the processes """
+        self.notified += 1
+        self._drop(restaurant_id, table_id)
+        if self.client is None or not self.enabled:
+            return
+        try:
+            self.client.publish(self.CHANNEL, json.dumps([restaurant_id, table_id]))
+        except Exception as e: # the other processes keep them until the ttl
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants BOOKINGS CACHE ERROR: %s", e)
+
+    def stats(self):
+        """ Return the counters of the cache as a dict """
+        stats = self.local.stats()
+        stats.update({"enabled": self.enabled, "notified": self.notified, "errors": self.errors})
+        return stats
+
+bookings_cache = BookingsCache()
@@ -58,4 +58,16 @@ class Error500(Error):
         self.type = "about:blank"
         self.title = "Internal Server Error"
         self.status = 500
-        self.detail = "An error occured, please try again"
\ No newline at end of file
+        self.detail = "An error occured, please try again"
+
+class Error504(Error):
+    def __init__(self, detail="The time budget of the request is exhausted"):
+        """ Gateway Timeout
+
+        Launched when the deadline given by the client (see utils.parse_deadline)
+        expires before the other microservices answer
+        """
+        self.type = "about:blank"
+        self.title = "Gateway Timeout"
+        self.status = 504
+        self.detail = detail
\ No newline at end of file
@@ -0,0 +1,406 @@
+""" The HTTP client of the calls to the other services (see utils.get_from)
+
+A single session is shared by the whole process: its connections are kept alive and reused
+by the next calls to the same host, so they do not pay a new TCP (and TLS) handshake.
+At most pool_size connections are kept for each host; when more calls are running at once
+the extra connections are opened and then closed (the pool is saturated, see stats).
+
+The connection errors are retried a few times, after a backoff doubled at every attempt
+and randomly jittered (the retries of the processes do not hit the service at the same time).
+A call may have a deadline: no attempt waits past it and none is started once it is too close.
+
+The latencies of the last calls to each host are kept (see LatencyWindow): the timeout of the calls
+can be derived from them (a multiple of a percentile, never above the configured timeout), so a stalled
+request is given up early. It is then sent once more with the rest of the configured timeout: a slow but
+healthy service is still waited for, a stalled one is not waited for longer than the configured timeout.
+A call slower than a percentile can be hedged: a duplicate request is sent and the first answer is taken.
+The duplicates are limited to a fraction of the calls (a token bucket), so a slow service does not get
+twice its load.
+
+The calls to a failing service are stopped for a while by a circuit breaker (see CircuitBreaker),
+so the requests fail at once instead of waiting for the timeout.
+"""
+import bisect
+import collections
+import logging
+import math
+import random
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+class LatencyWindow:
+    """ The latencies (in seconds) of the last size calls to a host """
+    def __init__(self, size):
+        self.lock = threading.Lock()
+        self.samples = collections.deque(maxlen=size)
+        self.sorted = [] # the samples in order, kept along (the window is small)
+
+    def add(self, latency):
+        with self.lock:
+            if len(self.samples) == self.samples.maxlen:
+                del self.sorted[bisect.bisect_left(self.sorted, self.samples[0])]
+            self.samples.append(latency)
+            bisect.insort(self.sorted, latency)
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p):
+        """ Return the p-th percentile (0-100) of the latencies, None without samples """
+        with self.lock:
+            if len(self.sorted) == 0:
+                return None
+            return self.sorted[min(len(self.sorted) - 1, int(len(self.sorted) * p / 100.0))]
+
+class HttpClient:
+    """ A process-wide pooled HTTP client with keep-alive, bounded retries, adaptive timeouts and hedged requests """
+    MIN_SAMPLES = 20 # latencies of a host needed before its timeout is adapted and its calls hedged
+    HEDGE_BURST = 10 # duplicate requests that can be sent in a row (the tokens saved)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None
+        self.executor = None
+        self.configure()
+
+    def configure(self, pool_size=10, retries=2, backoff=0.05,
+            window=200, timeout_percentile=0, timeout_multiplier=2, min_timeout=0.1, hedge_percentile=0, hedge_budget=0.1):
+        """ Set the connections kept per host, the retries of the connection errors and the first backoff (in seconds)
+
+        The timeout of the calls to a host is timeout_multiplier times the timeout_percentile of its last window latencies
+        (at least min_timeout), the calls slower than the hedge_percentile are hedged. 0 disables them.
+        At most hedge_budget duplicate requests are sent per call.
+        The open connections are closed.
+        """
+        if self.session is not None:
+            self.session.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.window = window
+        self.timeout_percentile = timeout_percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.min_timeout = min_timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_budget = hedge_budget
+        self.hedge_tokens = 0
+        self.workers = 2*pool_size
+        self.busy = 0 # workers reserved by the submitted requests
+        if hedge_percentile > 0:
+            self.executor = futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hedge")
+        self.latencies = {} # host -> LatencyWindow
+        self.adapter = HTTPAdapter(pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.requests = 0
+        self.retried = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.saturated = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.hedge_skipped = 0
+        self.extended = 0
+
+    def _window(self, host):
+        with self.lock:
+            window = self.latencies.get(host)
+            if window is None:
+                window = self.latencies[host] = LatencyWindow(self.window)
+            return window
+
+    def timeout_for(self, host, timeout):
+        """ Return the timeout of a call to host, timeout is the longest one """
+        window = self._window(host)
+        if self.timeout_percentile <= 0 or len(window) < self.MIN_SAMPLES:
+            return timeout
+        return min(timeout, max(self.min_timeout, self.timeout_multiplier * window.percentile(self.timeout_percentile)))
+
+    def hedge_delay(self, host):
+        """ Return the seconds after which a call to host is hedged, None if it is not """
+        window = self._window(host)
+        if self.hedge_percentile <= 0 or len(window) < self.MIN_SAMPLES:
+            return None
+        return window.percentile(self.hedge_percentile)
+
+    def get(self, url, timeout, headers=None, deadline=None):
+        """ Make a GET request, returns the response (raises the requests exceptions after the retries)
+
+        timeout is the longest timeout, the one used until the latencies of the host are known.
+        A request given up after the adaptive timeout is sent once more with what is left of the longest one:
+        the call never lasts more than timeout (without the retries of the connection errors).
+        deadline is the time.monotonic() after which the call is given up (the timeout of every attempt is cut to it).
+        """
+        host = urlsplit(url).netloc
+        longest = timeout
+        timeout = self.timeout_for(host, longest)
+        delay = self.hedge_delay(host)
+        with self.lock:
+            self.requests += 1
+            self.hedge_tokens = min(self.HEDGE_BURST, self.hedge_tokens + self.hedge_budget)
+            if self.in_flight >= self.pool_size:
+                self.saturated += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.monotonic()
+        try:
+            try:
+                if delay is None:
+                    return self._get(url, host, timeout, headers, deadline)
+                return self._hedged(url, host, timeout, delay, headers, deadline)
+            except requests.Timeout:
+                left = self._cut(longest - (time.monotonic() - start), deadline)
+                if timeout >= longest or left <= 0:
+                    raise
+            with self.lock:
+                self.extended += 1
+            return self._get(url, host, left, headers, deadline)
+        except Exception:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    @staticmethod
+    def _cut(timeout, deadline):
+        """ Return timeout cut to the seconds left before deadline (if any) """
+        if deadline is None:
+            return timeout
+        return min(timeout, deadline - time.monotonic())
+
+    def _retry(self, attempt, deadline):
+        """ Wait the backoff of a retry, returns False (at once) if there are no retries left or the deadline is closer """
+        pause = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+        if attempt >= self.retries or self._cut(pause, deadline) < pause:
+            return False
+        with self.lock:
+            self.retried += 1
+        time.sleep(pause)
+        return True
+
+    def _get(self, url, host, timeout, headers=None, deadline=None):
+        """ The GET request with its retries, its latency is recorded (the timeouts count as the whole timeout) """
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = self.session.get(url, timeout=max(0.001, self._cut(timeout, deadline)), headers=headers)
+                self._window(host).add(time.monotonic() - start)
+                return response
+            except requests.Timeout as e:
+                self._window(host).add(time.monotonic() - start)
+                if not isinstance(e, requests.ConnectionError) or not self._retry(attempt, deadline): # only the connect timeouts are retried
+                    raise
+            except requests.ConnectionError:
+                if not self._retry(attempt, deadline):
+                    raise
+            attempt += 1
+
+    def _submit(self, *args):
+        """ Run _get in a worker, returns its future (None if all the workers are busy: it would be queued) """
+        with self.lock:
+            if self.busy >= self.workers:
+                return None
+            self.busy += 1
+        future = self.executor.submit(self._get, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self.lock:
+            self.busy -= 1
+
+    def _spend_hedge(self):
+        """ Take a token of the hedging budget, returns False if there is none left """
+        with self.lock:
+            if self.hedge_tokens < 1:
+                self.hedge_skipped += 1
+                return False
+            self.hedge_tokens -= 1
+            return True
+
+    def _hedged(self, url, host, timeout, delay, headers=None, deadline=None):
+        """ Send the request, and a duplicate if there is no answer after delay seconds: the first successful answer is returned
+
+        The duplicate is sent only if the budget and a worker allow it. No answer is waited for more than timeout seconds,
+        nor past the deadline.
+        """
+        end = time.monotonic() + self._cut(timeout, deadline)
+        first = self._submit(url, host, timeout, headers, deadline)
+        if first is None:
+            return self._get(url, host, timeout, headers, deadline)
+        sent = [first]
+        done,pending = futures.wait(sent, timeout=delay)
+        if len(done) == 0 and self._spend_hedge():
+            second = self._submit(url, host, timeout, headers, deadline)
+            if second is not None:
+                with self.lock:
+                    self.hedged += 1
+                sent.append(second)
+                pending.add(second)
+        try:
+            while True:
+                for future in done:
+                    if future.exception() is None:
+                        if future is not first:
+                            with self.lock:
+                                self.hedge_wins += 1
+                        return future.result()
+                if len(pending) == 0:
+                    return first.result() # all failed
+                done,pending = futures.wait(pending, timeout=max(0, end - time.monotonic()), return_when=futures.FIRST_COMPLETED)
+                if len(done) == 0:
+                    raise requests.Timeout("no answer from %s after %s seconds" % (host, timeout))
+        finally:
+            for future in sent:
+                future.cancel() # if it is still queued, the running ones end with their timeout
+
+    def connections(self):
+        """ Return the number of connections opened and of requests sent by the pools of the hosts """
+        opened = sent = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                sent += pool.num_requests
+        return opened, sent
+
+    def stats(self):
+        """ Return the counters of the client as a dict """
+        opened,sent = self.connections()
+        return {
+            "pool_size": self.pool_size,
+            "requests": self.requests,
+            "connections": opened,
+            "reused": max(0, sent - opened), # requests sent on a kept-alive connection
+            "retries": self.retried,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "saturated": self.saturated, # requests started with all the pooled connections busy
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins, # hedged requests answered first by the duplicate
+            "hedge_skipped": self.hedge_skipped, # slow requests not hedged, out of budget
+            "extended": self.extended, # requests sent again with the rest of the longest timeout after the adaptive one
+            "latency": dict([(host, self.latency_stats(host)) for host in list(self.latencies)]),
+        }
+
+    def latency_stats(self, host):
+        """ Return the latencies (p50, p95, p99) of the calls to host and its current timeout, in seconds """
+        window = self._window(host)
+        stats = dict([("p%d" % p, window.percentile(p)) for p in [50, 95, 99]])
+        stats["samples"] = len(window)
+        timeout = self.timeout_for(host, math.inf)
+        stats["timeout"] = None if timeout == math.inf else timeout # None until it is adapted
+        stats["hedge_after"] = self.hedge_delay(host)
+        return stats
+
+http_client = HttpClient()
+
+class CircuitBreaker:
+    """ Stops the calls to a failing service for a while (fail fast)
+
+    - closed: the calls pass, after failures consecutive failures (errors or timeouts) the breaker opens
+    - open: the calls are rejected at once, after reset seconds the breaker is half open
+    - half_open: at most trials calls at a time pass (the probes), a success closes the breaker, a failure opens it again
+
+    allow returns a ticket (None if the call is rejected) that must be given back to record (or cancel).
+    The tickets carry the generation of the breaker (incremented at every change of state) they were issued in:
+    the results of the calls allowed before the last change are ignored, so a late success of a call allowed
+    while closed does not close an open breaker, and only the probes count in the half open state.
+    With failures = 0 the breaker is disabled (always closed).
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.configure()
+
+    def configure(self, failures=5, reset=10, trials=1):
+        with self.lock:
+            self.threshold = failures
+            self.reset = reset
+            self.trials = trials
+            self.state = self.CLOSED
+            self.generation = 0
+            self.failures = 0 # consecutive
+            self.opened_at = None
+            self.probing = 0 # calls allowed in half open state, not recorded yet
+            self.opened = 0
+            self.rejected = 0
+
+    def _change(self, state):
+        self.state = state
+        self.generation += 1
+
+    def allow(self):
+        """ Return the ticket of the call if it can be made (it must be recorded), None if it must fail at once """
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset:
+                self._change(self.HALF_OPEN)
+                self.probing = 0
+            if self.state == self.CLOSED:
+                return (self.generation, False)
+            if self.state == self.HALF_OPEN and self.probing < self.trials:
+                self.probing += 1
+                return (self.generation, True)
+            self.rejected += 1
+            return None
+
+    def cancel(self, ticket):
+        """ Forget an allowed call that ended neither with a success nor with a failure of the service """
+        with self.lock:
+            generation,probe = ticket
+            if probe and generation == self.generation:
+                self.probing = max(0, self.probing - 1)
+
+    def record(self, ticket, success):
+        """ Record the result of an allowed call (ignored if the state changed since it was allowed) """
+        with self.lock:
+            generation,probe = ticket
+            if generation != self.generation:
+                return
+            if probe:
+                self.probing = max(0, self.probing - 1)
+            if success:
+                if self.state != self.CLOSED:
+                    logging.info("- GoOutSafe:Restaurants %s BREAKER CLOSED", self.name.upper())
+                    self._change(self.CLOSED)
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.threshold > 0 and (self.state == self.HALF_OPEN or self.failures >= self.threshold):
+                self.opened += 1
+                logging.info("- GoOutSafe:Restaurants %s BREAKER OPEN after %d failures", self.name.upper(), self.failures)
+                self._change(self.OPEN)
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        """ Return the state and the counters of the breaker as a dict """
+        with self.lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "threshold": self.threshold,
+                "reset": self.reset,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
+
+bookings_breaker = CircuitBreaker("bookings")
@@ -1,17 +1,86 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import case, cast, func, or_
 from sqlalchemy.orm import relationship
+from sqlalchemy.schema import CreateIndex
 import datetime
+import sqlite3
 
 db = SQLAlchemy()
 
+class Serializer:
+    """ A precomputed serializer from the rows of a query over some columns of a model to dicts
+
+    The positions of the fields, of the url keys and the converters are resolved once for the columns,
+    so no attribute lookup or key scan is done for each row (it works on plain Core/ORM result rows).
+
+    - fields: the names of the returned fields (columns of the model and "url")
+    - url: the format of the url, filled with the values of the columns in url_keys
+    - converters: column name -> function applied to its value
+
+    The query must select the columns in self.columns (in this order, other columns may follow).
+    """
+    def __init__(self, model, fields, url, url_keys, converters={}):
+        names = [f for f in fields if f != "url"]
+        self.names = names + [k for k in url_keys if k not in names]
+        self.columns = [getattr(model, name) for name in self.names]
+
+        conversions = [(name, converters[name]) for name in names if name in converters]
+        url_positions = [self.names.index(k) for k in url_keys] if "url" in fields else None
+
+        def serialize(row):
+            d = dict(zip(names, row)) # the first len(names) columns
+            for name,convert in conversions:
+                d[name] = convert(d[name])
+            if url_positions is not None:
+                d["url"] = url % tuple([row[i] for i in url_positions])
+            return d
+        self.serialize = serialize
+
+    def __call__(self, row):
+        return self.serialize(row)
+
+    def dump_object(self, obj):
+        """ Serialize a model instance """
+        return self.serialize([getattr(obj, name) for name in self.names])
+
+_serializers = {} # (model, fields) -> Serializer
+
+def get_serializer(model, fields=None):
+    """ Return the (cached) serializer of a model for the given fields (all by default, unknown fields are ignored) """
+    if fields is None:
+        fields = model._dump_fields
+    fields = tuple([f for f in model._dump_fields if f in fields])
+    serializer = _serializers.get((model, fields))
+    if serializer is None:
+        serializer = Serializer(model, fields, model._dump_url, model._dump_url_keys, model._dump_converters)
+        _serializers[(model, fields)] = serializer
+    return serializer
+
+_closed_days = {} # there are only 128 possible values
+
+def closed_days_list(value):
+    """ Return the closed days stored as a string (e.g. "127") as a list of numbers """
+    days = _closed_days.get(value)
+    if days is None:
+        days = tuple([int(day) for day in value or ""])
+        _closed_days[value] = days
+    return list(days)
+
 class Restaurant(db.Model):
 
     __tablename__ = 'restaurant'
     __table_args__ = {'sqlite_autoincrement':True}
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, unique=True)
     name = db.Column(db.Text(100))
-    rating_val = db.Column(db.Float, default=0) # will store the mean value of the rating
+    rating_val = db.Column(db.Float, default=0) # will store the mean value of the rating (rating_sum/rating_num)
     rating_num = db.Column(db.Integer, default=0) # will store the number of ratings
+    rating_sum = db.Column(db.Integer, default=0) # will store the sum of the ratings, exact (not exported)
+    rating_0 = db.Column(db.Integer, default=0) # will store the number of ratings of each value, see rating_histogram (not exported)
+    rating_1 = db.Column(db.Integer, default=0)
+    rating_2 = db.Column(db.Integer, default=0)
+    rating_3 = db.Column(db.Integer, default=0)
+    rating_4 = db.Column(db.Integer, default=0)
+    rating_5 = db.Column(db.Integer, default=0)
     lat = db.Column(db.Float) # restaurant latitude
     lon = db.Column(db.Float) # restaurant longitude
     first_opening_hour = db.Column(db.Integer) # the opening hour for the first opening
@@ -23,42 +92,204 @@ class Restaurant(db.Model):
     phone = db.Column(db.Text(16))
     cuisine_type = db.Column(db.Text(1000))
     menu = db.Column(db.Text(1000))
+    opening_mask = db.Column(db.Integer) # weekly availability, see search.opening_mask (not exported, not indexed: a bit test cannot use it)
+    version = db.Column(db.Integer, default=0, server_default="0") # version of the last write, see next_version (not exported)
     tables = relationship('Table')
 
+    _dump_fields = ["id", "name", "rating_val", "rating_num", "lat", "lon", 
+        "first_opening_hour", "first_closing_hour", "second_opening_hour", "second_closing_hour", 
+        "occupation_time", "closed_days", "phone", "cuisine_type", "menu", "url"] # opening_mask is not returned
+    _dump_url = "/restaurants/%d"
+    _dump_url_keys = ["id"]
+    _dump_converters = {"closed_days": closed_days_list}
+
     def get_id(self):
         return self.id
 
-    def dump(self):
-        """ Return a db record as a dict """
-        d = dict([(k,v) for k,v in self.__dict__.items() if k[0] != '_'])
-        d["closed_days"] = [int(day) for day in d["closed_days"]]
-        d["url"] = "/restaurants/"+str(d["id"])
-        return d
+    @classmethod
+    def serializer(cls, fields=None):
+        """ Return the serializer of the given fields (all by default) for the rows of a query over Restaurant columns """
+        return get_serializer(cls, fields)
+
+    def dump(self, fields=None):
+        """ Return a db record as a dict (if fields is given only those fields are returned) """
+        return get_serializer(Restaurant, fields).dump_object(self)
 
     def dump_rating(self):
         """ Return a db record as a dict but with only rating and ratings"""
         d = {"rating": self.rating_val, "ratings": self.rating_num}
         return d
 
+RATING_VALUES = range(6) # the values of the ratings (0-5) counted by the histogram
+
+def rating_histogram():
+    """ Return the columns of Restaurant with the number of ratings of each value (in RATING_VALUES) """
+    return [getattr(Restaurant, "rating_%d" % value) for value in RATING_VALUES]
+
+def rating_value(rating=None):
+    """ Return the value of a rating (Rating.rating by default) counted by the histogram (rounded down, if the rating is not an integer) """
+    return cast(Rating.rating if rating is None else rating, db.Integer)
+
+def rating_counts(rating=None):
+    """ Return the aggregates counting the ratings (Rating.rating by default) of each value (in RATING_VALUES), for a GROUP BY """
+    return [func.sum(case([(rating_value(rating) == value, 1)], else_=0)) for value in RATING_VALUES]
+
+def fold_ratings(total, num, counts=None):
+    """ Return the values of an update of the restaurants that adds num ratings whose sum is total (removes them if negative)
+
+    The sum and the number are exact integers, the mean is derived from them: the updates are O(1) and do not drift.
+    counts, if given, are the numbers of the ratings of each value, added to the histogram.
+    total, num and counts may be numbers or bind parameters.
+    """
+    rating_sum = Restaurant.rating_sum + total
+    rating_num = Restaurant.rating_num + num
+    values = {
+        "rating_sum": rating_sum,
+        "rating_num": rating_num,
+        "rating_val": case([(rating_num > 0, cast(rating_sum, db.Float) / rating_num)], else_=0),
+    }
+    if counts is not None:
+        for column,count in zip(rating_histogram(), counts):
+            values[column.key] = column + count
+    return values
+
 class Table(db.Model):
     __tablename__ = 'table'
     __table_args__ = {'sqlite_autoincrement':True}
     id = db.Column(db.Integer, primary_key=True, autoincrement=True, unique=True)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'))
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), index=True)
     capacity = db.Column(db.Integer)
+    version = db.Column(db.Integer, default=0, server_default="0") # version of the last write, see next_version (not exported)
     restaurant = relationship('Restaurant')
 
+    _dump_fields = ["id", "restaurant_id", "capacity", "url"]
+    _dump_url = "/restaurants/%d/tables/%d"
+    _dump_url_keys = ["restaurant_id", "id"]
+    _dump_converters = {}
+
+    @classmethod
+    def serializer(cls, fields=None):
+        """ Return the serializer of the given fields (all by default) for the rows of a query over Table columns """
+        return get_serializer(cls, fields)
+
     def dump(self):
         """ Return a db record as a dict """
-        d = dict([(k,v) for k,v in self.__dict__.items() if k[0] != '_'])
-        d["url"] = "/restaurants/%d/tables/%d" % (d["restaurant_id"],d["id"])
-        return d
+        return get_serializer(Table).dump_object(self)
 
 class Rating(db.Model):
     __tablename__ = 'Rating'
-    __table_args__ = {'sqlite_autoincrement':True}
     rater_id = db.Column(db.Integer, primary_key=True)
-    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True, index=True) # indexed for the aggregations by restaurant
     restaurant = relationship('Restaurant', foreign_keys='Rating.restaurant_id')
     rating = db.Column(db.Integer)
-    marked = db.Column(db.Boolean, default = False) # True iff it has been counted in Restaurant.rating
\ No newline at end of file
+    marked = db.Column(db.Boolean, default = False) # True iff it has been counted in Restaurant.rating
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow) # NULL for the ratings older than the column
+    # only the unmarked ratings, in the order of the batches of check_ratings: the scan does not grow with the history
+    __table_args__ = (db.Index("ix_Rating_unmarked", rater_id, restaurant_id, sqlite_where=(marked == False)), {'sqlite_autoincrement':True})
+
+class RatingArchive(db.Model):
+    """ The old counted ratings, moved out of Rating by background.archive_ratings
+
+    They are still counted in the ratings of the restaurants (and recomputed with the others),
+    and still checked for the duplicate ratings.
+    """
+    __tablename__ = 'RatingArchive'
+    rater_id = db.Column(db.Integer, primary_key=True)
+    restaurant_id = db.Column(db.Integer, db.ForeignKey('restaurant.id'), primary_key=True, index=True)
+    rating = db.Column(db.Integer)
+    created = db.Column(db.DateTime)
+
+class Catalog(db.Model):
+    """ The version counters: the one of the catalog (of the restaurants), used to invalidate the caches, and the one of the tables """
+    __tablename__ = 'catalog'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0)
+
+CATALOG = 1 # the Catalog records
+TABLES = 2
+
+def init_catalog():
+    """ Create the catalog records if they are missing """
+    for counter in [CATALOG, TABLES]:
+        if db.session.query(Catalog).filter(Catalog.id == counter).first() is None:
+            db.session.add(Catalog(id=counter, version=0))
+    db.session.commit()
+
+def catalog_version():
+    """ Return the current version of the catalog """
+    return db.session.query(Catalog.version).filter(Catalog.id == CATALOG).scalar()
+
+def bump_catalog_version():
+    """ Increase the version of the catalog, in the current transaction (it must be committed by the caller)
+
+    It must be called by every write that changes the restaurants (and only by them, it drops the caches)
+    """
+    db.session.query(Catalog).filter(Catalog.id == CATALOG).update({Catalog.version: Catalog.version + 1}, synchronize_session=False)
+    db.session.info["catalog_changed"] = True # see app.catalog_committed
+
+_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+def next_version(counter=CATALOG):
+    """ Bump a version counter and return it, to be stored in the version of the written records
+
+    The versions increase at every write, so the max version of a set of records changes
+    whenever one of them is written (used for the ETags).
+    The restaurants use the version of the catalog (CATALOG), the tables their own (TABLES):
+    the writes of the tables do not drop the caches of the restaurants.
+    """
+    if counter == CATALOG:
+        db.session.info["catalog_changed"] = True # see app.catalog_committed
+    if _RETURNING and db.session.bind.dialect.name == "sqlite": # a single statement
+        return db.session.execute("UPDATE catalog SET version = version + 1 WHERE id = :id RETURNING version", {"id": counter}).scalar()
+    db.session.query(Catalog).filter(Catalog.id == counter).update({Catalog.version: Catalog.version + 1}, synchronize_session=False)
+    return db.session.query(Catalog.version).filter(Catalog.id == counter).scalar()
+
+def init_rating_aggregates():
+    """ Add the rating_sum and histogram columns to the old databases and backfill them, returns the number of backfilled restaurants
+
+    The existing counters (rating_num and rating_val) are kept: the sum is the one of the counted (marked) ratings
+    if they are all still in the table, otherwise it is derived from the mean (rounded).
+    The histogram counts the marked ratings (the older ones were not kept). Only the missing (NULL) values are written.
+    """
+    add_missing_columns(Restaurant)
+    marked = db.session.query(Rating).filter(Rating.restaurant_id == Restaurant.id, Rating.marked == True)
+    marked_sum = func.coalesce(marked.with_entities(func.sum(Rating.rating)).as_scalar(), 0)
+    marked_num = marked.with_entities(func.count()).as_scalar()
+    rating_num = func.coalesce(Restaurant.rating_num, 0)
+    rating_sum = case([(rating_num == marked_num, marked_sum)],
+        else_=cast(func.round(func.coalesce(Restaurant.rating_val, 0) * rating_num), db.Integer))
+    values = {Restaurant.rating_sum: func.coalesce(Restaurant.rating_sum, rating_sum)}
+    no_histogram = or_(*[column == None for column in rating_histogram()]) # its columns are added together
+    for value,column in zip(RATING_VALUES, rating_histogram()):
+        values[column] = case([(no_histogram, marked.filter(rating_value() == value).with_entities(func.count()).as_scalar())], else_=column)
+    count = db.session.query(Restaurant).filter(or_(Restaurant.rating_sum == None, no_histogram)) \
+        .update(values, synchronize_session=False)
+    db.session.commit()
+    return count
+
+def add_missing_columns(model):
+    """ Add to the table of the model the columns that are missing in the database.
+
+    db.create_all does not alter the tables that already exist, 
+    so the columns added to the models must be added by hand to the old databases.
+    The new columns are NULL for the existing rows (they must be backfilled by the caller),
+    unless they have a server default.
+
+    Returns the list of the added columns
+    """
+    table = model.__table__
+    existing = [row[1] for row in db.session.execute('PRAGMA table_info("%s")' % table.name)]
+    added = []
+    for col in table.columns:
+        if col.name not in existing:
+            col_type = col.type.compile(dialect=db.engine.dialect)
+            if col.server_default is not None:
+                col_type += " DEFAULT %s" % col.server_default.arg
+            db.session.execute('ALTER TABLE "%s" ADD COLUMN %s %s' % (table.name, col.name, col_type))
+            added.append(col.name)
+    indexes = [row[1] for row in db.session.execute('PRAGMA index_list("%s")' % table.name)]
+    for index in table.indexes:
+        if index.name not in indexes:
+            db.session.execute(CreateIndex(index))
+    db.session.commit()
+    return added
@@ -0,0 +1,359 @@
+""" Write-behind ingestion of the ratings
+
+In write-behind mode (RATINGS_QUEUE_URL) POST /restaurants/{id}/rate only pushes the accepted
+rating on a redis list and answers 202: the ratings are inserted in bulk by the worker
+(background.flush_ratings), so the requests never wait for the database write lock.
+
+The list is drained by batches claimed atomically (see RatingQueue.claim), so the flushes running
+at the same time never get the same ratings. A claimed batch is removed only after it is inserted,
+a failed flush gives it back to the list and a flush that died is taken over after CLAIM_TIMEOUT:
+the ratings may be inserted twice, but never lost (the insert ignores the duplicates, see utils.add_ratings).
+
+The rating of a restaurant is updated a few seconds after its new ratings (RatingEvents),
+a burst of ratings produces one update.
+
+The "already rated" check of the new ratings is answered by a Bloom filter (RatedFilter)
+when the pair (restaurant, rater) is certainly missing, skipping the query. Its bits are
+checked in memory and shared by the processes through redis.
+"""
+import hashlib
+import json
+import logging
+import math
+import time
+import uuid
+
+class RatingQueue:
+    """ A durable FIFO queue of ratings (restaurant_id, rater_id, rating) on a redis list
+
+    The ratings are taken in batches: each one is moved to a list of its own (claim) and deleted
+    once stored (ack). The claimed batches are registered in the sorted set CLAIMS by claim time.
+
+    Without a client the queue is disabled: the ratings are written synchronously.
+    """
+    KEY = "restaurants:ratings"
+    CLAIMS = "restaurants:ratings:claims"
+    CLAIM_TIMEOUT = 300 # seconds after which a batch not acknowledged is given back to the queue (its flush died)
+
+    def __init__(self):
+        self.configure(None)
+
+    def configure(self, client):
+        self.client = client
+        self.pushed = 0
+        self.flushed = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def push(self, restaurant_id, rater_id, rating):
+        """ Append a rating to the queue, returns False if redis cannot be reached """
+        try:
+            self.client.rpush(self.KEY, json.dumps([restaurant_id, rater_id, rating]))
+        except Exception as e:
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATING QUEUE ERROR: %s", e)
+            return False
+        self.pushed += 1
+        return True
+
+    def claim(self, size):
+        """ Take the first size ratings of the queue, returns the key of the batch and its ratings (as tuples)
+
+        Every rating is moved to the batch by an atomic LMOVE, so it is taken by one caller only.
+        The batch must be acknowledged (ack) or given back (release).
+        """
+        batch = "%s:claimed:%s" % (self.KEY, uuid.uuid4().hex)
+        self.client.zadd(self.CLAIMS, {batch: time.time()}) # before the moves: a batch is always found by requeue_expired
+        pipe = self.client.pipeline()
+        for _ in range(min(size, self.client.llen(self.KEY))):
+            pipe.lmove(self.KEY, batch, "LEFT", "RIGHT")
+        return batch, [tuple(json.loads(item)) for item in pipe.execute() if item is not None]
+
+    def ack(self, batch, size):
+        """ Delete a claimed batch of size ratings (once they are stored) """
+        pipe = self.client.pipeline()
+        pipe.delete(batch)
+        pipe.zrem(self.CLAIMS, batch)
+        pipe.execute()
+        self.flushed += size
+
+    def release(self, batch):
+        """ Give the ratings of a claimed batch back to the head of the queue (they could not be stored) """
+        while self.client.lmove(batch, self.KEY, "RIGHT", "LEFT") is not None:
+            pass
+        self.client.zrem(self.CLAIMS, batch)
+
+    def requeue_expired(self, timeout=None):
+        """ Give back the batches claimed more than timeout seconds ago (CLAIM_TIMEOUT by default), returns their number """
+        expired = self.client.zrangebyscore(self.CLAIMS, 0, time.time() - (self.CLAIM_TIMEOUT if timeout is None else timeout))
+        for batch in expired:
+            batch = batch.decode() if isinstance(batch, bytes) else batch
+            logging.info("- GoOutSafe:Restaurants RATING QUEUE REQUEUE: %s", batch)
+            self.release(batch)
+        return len(expired)
+
+    def stats(self):
+        """ Return the counters of the queue as a dict """
+        try:
+            size = self.client.llen(self.KEY) if self.enabled else 0
+        except Exception:
+            size = None
+        return {
+            "enabled": self.enabled,
+            "size": size,
+            "pushed": self.pushed,
+            "flushed": self.flushed,
+            "errors": self.errors,
+        }
+
+rating_queue = RatingQueue()
+
+class RatingEvents:
+    """ The pending updates of the ratings of the restaurants (debounced), on redis
+
+    The first new rating of a restaurant claims its update (a key set only if missing) and schedules it
+    after debounce seconds, the next ones find the claim and do nothing: a burst of ratings produces one update.
+    The update releases the claim before counting, so the ratings arriving meanwhile schedule another one.
+    The claims expire (after ten debounces, at least a minute) in case an update is lost.
+
+    Without a client the events are disabled: the ratings are counted only by the periodic check_ratings.
+    """
+    PREFIX = "restaurants:rating-update:"
+
+    def __init__(self):
+        self.configure(None)
+
+    def configure(self, client, debounce=2):
+        self.client = client
+        self.debounce = debounce
+        self.scheduled = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def claim(self, restaurant_id):
+        """ Return True if the update of the restaurant must be scheduled (it was not pending) """
+        try:
+            claimed = self.client.set(self.PREFIX + str(restaurant_id), "1", ex=max(60, int(self.debounce * 10)), nx=True)
+        except Exception as e:
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATING EVENTS ERROR: %s", e)
+            return False
+        if claimed:
+            self.scheduled += 1
+        else:
+            self.coalesced += 1
+        return bool(claimed)
+
+    def release(self, restaurant_id):
+        if self.client is None:
+            return
+        try:
+            self.client.delete(self.PREFIX + str(restaurant_id))
+        except Exception as e: # it expires
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATING EVENTS ERROR: %s", e)
+
+    def stats(self):
+        """ Return the counters of the events as a dict """
+        return {
+            "enabled": self.enabled,
+            "debounce": self.debounce,
+            "scheduled": self.scheduled,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+        }
+
+rating_events = RatingEvents()
+
+class RatedFilter:
+    """ A Bloom filter of the pairs (restaurant_id, rater_id) that have a rating
+
+    might_contain is never wrong when it returns False (the pair has no rating),
+    it returns True for a missing pair with probability error_rate (while there are less than capacity pairs).
+    It is sized as m = -capacity*ln(error_rate)/ln(2)^2 bits and k = m/capacity*ln(2) hashes.
+
+    The bits are checked in the memory of the process (no round trip). Redis keeps them across the restarts
+    and shares the inserts: every process must see all of them, otherwise it would answer False for a pair
+    added by another one (and the duplicate would be accepted). The added pairs are published on CHANNEL
+    and the bits of redis are merged every SYNC seconds (the messages missed meanwhile).
+    The bit at position size of the redis bitmap marks it as warmed: it is lost with the bitmap,
+    and the filter is then warmed again from the database.
+
+    The filter is disabled (might_contain is always True) without a client, and until it is configured and warmed.
+    """
+    CHANNEL = "restaurants:rated"
+    SYNC = 10 # seconds between the merges of the bits kept in redis
+
+    def __init__(self):
+        self.thread = None
+        self.configure(0, 0.01)
+
+    def configure(self, capacity, error_rate, client=None):
+        """ Size the filter (capacity 0 disables it), it must be warmed before it is used """
+        if self.thread is not None: # stop listening to the previous client
+            self.thread.stop()
+            self.thread = None
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = 0
+        self.hashes = 0
+        if capacity > 0:
+            self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+            self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray(self.size // 8 + 1) # the bits of redis (bit 0 is the highest of the first byte), and the marker
+        self.client = client
+        self.key = "restaurants:rated:%d:%d" % (self.size, self.hashes) # a new layout gets a new key
+        self.pairs = None
+        self.unsaved = False # bits added while redis could not be reached
+        self.ready = False
+        self.synced = time.monotonic()
+        self.checks = 0
+        self.skipped = 0
+        self.false_positives = 0
+        self.rewarmed = 0
+        self.errors = 0
+        if client is not None and self.size > 0:
+            self.pubsub = client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub.subscribe(**{self.CHANNEL: self._on_add})
+            self.thread = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    @property
+    def enabled(self):
+        return self.ready
+
+    def _positions(self, restaurant_id, rater_id):
+        """ The k bits of a pair (double hashing of a 128 bit digest) """
+        digest = hashlib.blake2b(b"%d:%d" % (restaurant_id, rater_id), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i*h2) % self.size for i in range(self.hashes)]
+
+    def _set(self, positions):
+        for pos in positions:
+            self.bits[pos >> 3] |= 0x80 >> (pos & 7)
+
+    def _fill(self, pairs):
+        count = 0
+        for restaurant_id,rater_id in (pairs() if callable(pairs) else pairs):
+            self._set(self._positions(restaurant_id, rater_id))
+            count += 1
+        return count
+
+    def _merge(self):
+        """ Merge the bits of redis, returns False if they are missing (never warmed, or lost) """
+        if not self.client.getbit(self.key, self.size):
+            return False
+        for i,byte in enumerate((self.client.get(self.key) or b"")[:len(self.bits)]):
+            self.bits[i] |= byte
+        return True
+
+    def _store(self):
+        """ Merge the bits of the process into redis, with the marker """
+        self._set([self.size])
+        temp = self.key + ":" + uuid.uuid4().hex
+        pipe = self.client.pipeline()
+        pipe.set(temp, bytes(self.bits))
+        pipe.bitop("OR", self.key, self.key, temp)
+        pipe.delete(temp)
+        pipe.execute()
+
+    def warm(self, pairs):
+        """ Fill the filter with the pairs (restaurant_id, rater_id) and enable it, returns the number of added pairs
+
+        The bits kept in redis are loaded instead if they are there (the pairs are not read).
+        pairs may be a function returning them, called only if needed: it is kept to warm the filter again.
+        """
+        if self.size == 0 or self.client is None:
+            return 0
+        self.pairs = pairs
+        try:
+            if self._merge():
+                self.ready = True
+                return 0
+            count = self._fill(pairs)
+            self._store()
+        except Exception as e:
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATED FILTER ERROR: %s", e)
+            return 0
+        self.synced = time.monotonic()
+        self.ready = True
+        return count
+
+    def _sync(self):
+        """ Merge the bits of redis every SYNC seconds, the filter is warmed again if they were lost """
+        if time.monotonic() - self.synced < self.SYNC:
+            return
+        self.synced = time.monotonic()
+        try:
+            if not self._merge():
+                logging.info("- GoOutSafe:Restaurants RATED FILTER LOST, warming it again")
+                self.rewarmed += 1
+                self._fill(self.pairs)
+                self.unsaved = True
+            if self.unsaved:
+                self._store()
+                self.unsaved = False
+        except Exception as e: # the local bits are still right, the next sync tries again
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATED FILTER ERROR: %s", e)
+
+    def _on_add(self, message):
+        restaurant_id,rater_id = message["data"].split(b":")
+        self._set(self._positions(int(restaurant_id), int(rater_id)))
+
+    def add(self, restaurant_id, rater_id):
+        """ Add a pair (after its rating is accepted), even if this process did not warm the filter """
+        if self.size == 0 or self.client is None:
+            return
+        positions = self._positions(restaurant_id, rater_id)
+        self._set(positions)
+        try:
+            pipe = self.client.pipeline()
+            for pos in positions:
+                pipe.setbit(self.key, pos, 1)
+            pipe.publish(self.CHANNEL, "%d:%d" % (restaurant_id, rater_id))
+            pipe.execute()
+        except Exception as e: # stored by the next sync
+            self.unsaved = True
+            self.errors += 1
+            logging.info("- GoOutSafe:Restaurants RATED FILTER ERROR: %s", e)
+
+    def might_contain(self, restaurant_id, rater_id):
+        """ Return False if the pair certainly has no rating, True if it may have one (or the filter is disabled) """
+        if not self.ready:
+            return True
+        self._sync()
+        self.checks += 1
+        found = all([self.bits[pos >> 3] & (0x80 >> (pos & 7)) for pos in self._positions(restaurant_id, rater_id)])
+        if not found:
+            self.skipped += 1
+        return found
+
+    def false_positive(self):
+        """ Count a pair found by might_contain without a rating (in the database, it may still be queued) """
+        self.false_positives += 1
+
+    def stats(self):
+        """ Return the counters of the filter as a dict """
+        return {
+            "enabled": self.ready,
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "bits": self.size,
+            "hashes": self.hashes,
+            "checks": self.checks,
+            "skipped": self.skipped,
+            "false_positives": self.false_positives,
+            "rewarmed": self.rewarmed,
+            "errors": self.errors,
+        }
+
+rated_filter = RatedFilter()
@@ -0,0 +1,123 @@
+""" Embedded scheduler of the background tasks
+
+With SCHEDULER the app runs the periodic tasks of the worker (check_ratings, flush_ratings,
+archive_ratings, recompute_ratings) in a thread of its own process: a single node deployment
+needs neither the Celery worker nor the broker. The tasks are applied locally (task.apply()),
+so they run the same code, with the app context, as in the worker.
+
+The runs are spread by a random jitter (a fraction of their interval), so the processes started
+together do not hit the database at the same time. Only one process of the node runs the tasks:
+the one holding the lock file (flock, released by the system if the process dies), the others
+try again at every tick and take over.
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover (not on windows, every process runs the tasks)
+    fcntl = None
+
+class Scheduler:
+    """ Runs some functions periodically in a daemon thread, in one process at a time (see the module)
+
+    Without jobs (or until it is started) the scheduler is disabled.
+    """
+    def __init__(self):
+        self.thread = None
+        self.configure(None)
+
+    def configure(self, lock_path, jitter=0.1, tick=1):
+        """ Stop the scheduler and forget its jobs, lock_path is the lock file shared by the processes (None to run anyway) """
+        self.stop()
+        self.lock_path = lock_path
+        self.jitter = jitter
+        self.tick = tick
+        self.jobs = [] # [name, interval, function, next run]
+        self.lock_file = None
+        self.runs = {}
+        self.errors = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self):
+        return self.thread is not None
+
+    def add(self, name, interval, function):
+        """ Run function every interval seconds (the first time after one interval) """
+        self.jobs.append([name, interval, function, time.monotonic() + self._delay(interval)])
+        self.runs[name] = 0
+
+    def _delay(self, interval):
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def is_leader(self):
+        """ Return True if this process holds the lock (the lock is taken if it is free) """
+        if self.lock_file is not None or self.lock_path is None or fcntl is None:
+            return True
+        lock_file = open(self.lock_path, "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError: # held by another process
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        logging.info("- GoOutSafe:Restaurants SCHEDULER LEADER (pid %d)", os.getpid())
+        return True
+
+    def run_pending(self):
+        """ Run the jobs that are due (if this process is the leader), returns the number of runs """
+        now = time.monotonic()
+        due = [job for job in self.jobs if job[3] <= now]
+        if len(due) == 0:
+            return 0
+        for job in due:
+            job[3] = now + self._delay(job[1])
+        if not self.is_leader():
+            self.skipped += len(due)
+            return 0
+        for name,interval,function,_ in due:
+            try:
+                function()
+                self.runs[name] += 1
+            except Exception as e:
+                self.errors += 1
+                logging.info("- GoOutSafe:Restaurants SCHEDULER ERROR (%s): %s", name, e)
+        return len(due)
+
+    def start(self):
+        """ Run the jobs in a daemon thread until stop """
+        self.stop()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._loop, args=(self.stopped,), name="scheduler", daemon=True)
+        self.thread.start()
+
+    def _loop(self, stopped):
+        while not stopped.wait(self.tick):
+            self.run_pending()
+
+    def stop(self):
+        """ Stop the thread (the running job is completed) and release the lock """
+        if self.thread is not None:
+            self.stopped.set()
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.thread = None
+        if getattr(self, "lock_file", None) is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def stats(self):
+        """ Return the counters of the scheduler as a dict """
+        return {
+            "enabled": self.enabled,
+            "leader": self.enabled and (self.lock_file is not None or self.lock_path is None or fcntl is None),
+            "runs": dict(self.runs),
+            "skipped": self.skipped,
+            "errors": self.errors,
+        }
+
+scheduler = Scheduler()
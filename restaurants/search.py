@@ -0,0 +1,321 @@
+""" Search indexes over the restaurant catalog.
+
+The text filters of GET /restaurants (name, cuisine_type, menu) are served
+by an SQLite FTS5 index (restaurant_fts) kept in sync with the restaurant
+table by triggers, so every write done by add_restaurant, edit_restaurant
+and del_restaurant (or by anything else) updates the index as well.
+
+The opening_time and open_day filters are served by Restaurant.opening_mask,
+a precomputed bitmask of the weekly openings derived by add_restaurant and
+edit_restaurant. It is tested on the rows read by the other filters (a bit test
+cannot use a B-tree index, so it has none).
+
+The "near me" search is served by an SQLite R*Tree (restaurant_geo) over
+Restaurant.lat/lon, kept in sync by triggers like the full-text index:
+only the restaurants in the bounding box of the circle are read, then
+their exact (haversine) distance is computed. Sorted by distance, the distance
+is computed by SQLite (the haversine function registered on its connections),
+so the order, the keyset of the pages and the limit are applied by the query.
+"""
+import logging
+import math
+import re
+import sqlite3
+
+from sqlalchemy import event, func, literal_column, text, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import column, table
+
+from restaurants.orm import db, Restaurant, add_missing_columns
+
+FTS_TABLE = "restaurant_fts"
+FTS_COLUMNS = ["name", "cuisine_type", "menu"]
+
+""" The fts5 table only stores the index: the content is read from the restaurant table """
+_FTS_CREATE = (
+    "CREATE VIRTUAL TABLE %s USING fts5(name, cuisine_type, menu, "
+    "content='restaurant', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')" % FTS_TABLE
+)
+
+_FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS restaurant_fts_ai AFTER INSERT ON restaurant BEGIN
+        INSERT INTO restaurant_fts(rowid, name, cuisine_type, menu) VALUES (new.id, new.name, new.cuisine_type, new.menu);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_fts_ad AFTER DELETE ON restaurant BEGIN
+        INSERT INTO restaurant_fts(restaurant_fts, rowid, name, cuisine_type, menu) VALUES ('delete', old.id, old.name, old.cuisine_type, old.menu);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_fts_au AFTER UPDATE OF name, cuisine_type, menu ON restaurant BEGIN
+        INSERT INTO restaurant_fts(restaurant_fts, rowid, name, cuisine_type, menu) VALUES ('delete', old.id, old.name, old.cuisine_type, old.menu);
+        INSERT INTO restaurant_fts(rowid, name, cuisine_type, menu) VALUES (new.id, new.name, new.cuisine_type, new.menu);
+    END""",
+]
+
+restaurant_fts = table(FTS_TABLE, column("rowid"), column("rank"))
+
+GEO_TABLE = "restaurant_geo"
+EARTH_RADIUS_KM = 6371.0088
+
+_GEO_CREATE = "CREATE VIRTUAL TABLE %s USING rtree(id, min_lat, max_lat, min_lon, max_lon)" % GEO_TABLE
+
+_GEO_FILL = """INSERT INTO restaurant_geo(id, min_lat, max_lat, min_lon, max_lon)
+    SELECT id, lat, lat, lon, lon FROM restaurant WHERE lat IS NOT NULL AND lon IS NOT NULL"""
+
+_GEO_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS restaurant_geo_ai AFTER INSERT ON restaurant BEGIN
+        INSERT INTO restaurant_geo(id, min_lat, max_lat, min_lon, max_lon) 
+            SELECT new.id, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_geo_ad AFTER DELETE ON restaurant BEGIN
+        DELETE FROM restaurant_geo WHERE id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS restaurant_geo_au AFTER UPDATE OF lat, lon ON restaurant BEGIN
+        DELETE FROM restaurant_geo WHERE id = old.id;
+        INSERT INTO restaurant_geo(id, min_lat, max_lat, min_lon, max_lon) 
+            SELECT new.id, new.lat, new.lat, new.lon, new.lon WHERE new.lat IS NOT NULL AND new.lon IS NOT NULL;
+    END""",
+]
+
+restaurant_geo = table(GEO_TABLE, column("id"), column("min_lat"), column("max_lat"), column("min_lon"), column("max_lon"))
+
+def _table_exists(name):
+    q = text("SELECT name FROM sqlite_master WHERE name = :name")
+    return db.session.execute(q, {"name": name}).first() is not None
+
+def init_search_index():
+    """ Create the full-text index (and its triggers) if it is missing.
+
+    When the index is created on an existing database it is filled (rebuilt) from the restaurant table.
+
+    Returns True if the index can be used, False otherwise (e.g. sqlite compiled without fts5)
+    """
+    try:
+        if not _table_exists(FTS_TABLE):
+            logging.info("- GoOutSafe:Restaurants Building Search Index...")
+            db.session.execute(text(_FTS_CREATE))
+            db.session.execute(text("INSERT INTO %s(%s) VALUES('rebuild')" % (FTS_TABLE, FTS_TABLE)))
+        for trigger in _FTS_TRIGGERS:
+            db.session.execute(text(trigger))
+        db.session.commit()
+        return True
+    except Exception as e:
+        logging.info("- GoOutSafe:Restaurants SEARCH INDEX ERROR: %s", e)
+        db.session.rollback()
+        return False
+
+def init_geo_index():
+    """ Create the spatial index (and its triggers) if it is missing, filling it from the restaurant table.
+
+    Returns True if the index can be used, False otherwise (e.g. sqlite compiled without rtree)
+    """
+    try:
+        if not _table_exists(GEO_TABLE):
+            logging.info("- GoOutSafe:Restaurants Building Geo Index...")
+            db.session.execute(text(_GEO_CREATE))
+            db.session.execute(text(_GEO_FILL))
+        for trigger in _GEO_TRIGGERS:
+            db.session.execute(text(trigger))
+        db.session.commit()
+        return True
+    except Exception as e:
+        logging.info("- GoOutSafe:Restaurants GEO INDEX ERROR: %s", e)
+        db.session.rollback()
+        return False
+
+def drop_search_index():
+    """ Drop the full-text and the spatial indexes (the triggers are dropped together with the restaurant table) """
+    db.session.execute(text("DROP TABLE IF EXISTS %s" % FTS_TABLE))
+    db.session.execute(text("DROP TABLE IF EXISTS %s" % GEO_TABLE))
+    db.session.commit()
+
+def fts_terms(value):
+    """ Translate a user string in an fts5 expression matching all its words as prefixes
+
+    e.g. 'Pasta bolo' -> '"pasta"* AND "bolo"*'
+
+    Returns None if the string does not contain any word
+    """
+    words = re.findall(r"[^\W_]+", value.lower()) # same word boundaries of the unicode61 tokenizer
+    if len(words) == 0:
+        return None
+    return " AND ".join(['"%s"*' % w for w in words])
+
+def text_search(q, filters, use_index=True):
+    """ Apply the text filters to a query over Restaurant.
+
+    - filters: dict column -> searched string (None values are ignored)
+    - use_index: use the full-text index, otherwise fall back to a substring match
+
+    Strings without words (e.g. "") cannot be matched by the index and keep the substring match.
+
+    Returns the query and True if it has been matched against the index 
+    (only then restaurant_fts.c.rank, the relevance, can be used: the lower the better)
+    """
+    expressions = []
+    for col in FTS_COLUMNS:
+        value = filters.get(col)
+        if value is None:
+            continue
+        terms = fts_terms(value) if use_index else None
+        if terms is None:
+            q = q.filter(getattr(Restaurant, col).contains(value))
+        else:
+            expressions.append("%s : (%s)" % (col, terms))
+
+    if len(expressions) == 0:
+        return q,False
+
+    q = q.join(restaurant_fts, restaurant_fts.c.rowid == Restaurant.id)
+    q = q.filter(literal_column(FTS_TABLE).match(" AND ".join(expressions)))
+    return q,True
+
+""" Layout of Restaurant.opening_mask:
+    - bits 0-23: set if the restaurant is open at that hour
+    - bits 24-30: set if the restaurant is closed in that day (1-7 i.e. monday-sunday)
+"""
+HOURS = 24
+CLOSED_DAY_SHIFT = 24
+BACKFILL_CHUNK = 1000
+
+def opening_mask(first_opening_hour, first_closing_hour, second_opening_hour, second_closing_hour, closed_days):
+    """ Return the weekly availability bitmask of a restaurant
+
+    An hour is open if it is between the opening and the closing hour (both included) of one of the openings,
+    an opening is ignored if one of its hours is missing.
+
+    - closed_days: the closed days as a string of digits or as an iterable of integers
+    """
+    mask = 0
+    for opening,closing in [(first_opening_hour, first_closing_hour), (second_opening_hour, second_closing_hour)]:
+        if opening is not None and closing is not None:
+            for hour in range(max(int(opening), 0), min(int(closing), HOURS-1)+1):
+                mask |= 1 << hour
+    for day in closed_days or []:
+        mask |= 1 << (CLOSED_DAY_SHIFT + int(day) - 1)
+    return mask
+
+def restaurant_opening_mask(restaurant):
+    """ Return the weekly availability bitmask of a Restaurant record """
+    return opening_mask(restaurant.first_opening_hour, restaurant.first_closing_hour,
+        restaurant.second_opening_hour, restaurant.second_closing_hour, restaurant.closed_days)
+
+def opening_search(q, opening_time=None, open_day=None):
+    """ Filter a query over Restaurant keeping the restaurants open at the hour (0-23) and/or in the day (1-7)
+
+    Both the conditions are checked with a single bit test on the mask: (mask & (hour|day)) == hour
+    """
+    bits = 0
+    expected = 0
+    if opening_time is not None:
+        bits |= 1 << opening_time
+        expected |= 1 << opening_time
+    if open_day is not None:
+        bits |= 1 << (CLOSED_DAY_SHIFT + open_day - 1)
+    if bits == 0:
+        return q
+    return q.filter(Restaurant.opening_mask.op("&")(bits) == expected)
+
+def init_opening_index():
+    """ Add the opening_mask column to old databases and backfill it where it is missing (in chunks, by id)
+
+    The index of the mask created by the older versions is dropped (it was never used by the searches).
+    Returns the number of backfilled restaurants
+    """
+    add_missing_columns(Restaurant)
+    db.session.execute("DROP INDEX IF EXISTS ix_restaurant_opening_mask")
+    db.session.commit()
+    count = 0
+    last = 0
+    while True:
+        chunk = db.session.query(Restaurant).filter(Restaurant.id > last, Restaurant.opening_mask.is_(None)) \
+            .order_by(Restaurant.id).limit(BACKFILL_CHUNK).all()
+        if len(chunk) == 0:
+            break
+        for restaurant in chunk:
+            restaurant.opening_mask = restaurant_opening_mask(restaurant)
+        last = chunk[-1].id
+        db.session.commit()
+        count += len(chunk)
+    if count > 0:
+        logging.info("- GoOutSafe:Restaurants Opening Index: %d restaurants backfilled", count)
+    return count
+
+def parse_point(value):
+    """ Parse a "lat,lon" string, returns the pair (lat, lon) or None if it is not a valid point """
+    try:
+        lat,lon = [float(v) for v in value.split(",")]
+    except ValueError:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat,lon
+
+def haversine(lat1, lon1, lat2, lon2):
+    """ Return the distance in km between two points """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2-phi1)/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(math.radians(lon2-lon1)/2)**2
+    return 2*EARTH_RADIUS_KM*math.asin(min(1, math.sqrt(a)))
+
+def _sql_haversine(lat1, lon1, lat2, lon2):
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    return haversine(lat1, lon1, lat2, lon2)
+
+@event.listens_for(Engine, "connect")
+def register_functions(dbapi_connection, connection_record):
+    """ Register haversine(lat1, lon1, lat2, lon2) on the SQLite connections (the same values as in python) """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function("haversine", 4, _sql_haversine, deterministic=True)
+
+def bounding_box(lat, lon, radius_km):
+    """ Return (min_lat, max_lat, min_lon, max_lon) of a box containing the circle
+
+    Near the poles or across the antimeridian the box takes all the longitudes
+    """
+    delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    min_lat = lat - delta
+    max_lat = lat + delta
+    if min_lat <= -90 or max_lat >= 90:
+        return max(min_lat, -90), min(max_lat, 90), -180, 180
+    delta_lon = math.degrees(math.asin(math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat))))
+    if lon - delta_lon < -180 or lon + delta_lon > 180:
+        return min_lat, max_lat, -180, 180
+    return min_lat, max_lat, lon - delta_lon, lon + delta_lon
+
+def geo_search(q, lat, lon, radius_km, use_index=True, by_distance=False, limit=None, after=None):
+    """ Run a query over Restaurant keeping the restaurants within radius_km from (lat, lon)
+
+    Only the candidates in the bounding box are read from the database (through the spatial index if use_index),
+    then they are filtered by their exact distance.
+
+    The query yields rows with the lat, lon and id columns (e.g. query(Restaurant.id, Restaurant.lat, Restaurant.lon, ...)).
+
+    Returns a list of pairs (row, distance in km), 
+    in the order of the query (stopping after limit results, if any) or from the nearest if by_distance.
+    By distance the order replaces the one of the query, and after is the (distance, id) of the last restaurant
+    of the previous page: the distance, the order, after and limit are all applied by the database.
+    """
+    min_lat, max_lat, min_lon, max_lon = bounding_box(lat, lon, radius_km)
+    if use_index:
+        q = q.join(restaurant_geo, restaurant_geo.c.id == Restaurant.id).filter(
+            restaurant_geo.c.max_lat >= min_lat, restaurant_geo.c.min_lat <= max_lat,
+            restaurant_geo.c.max_lon >= min_lon, restaurant_geo.c.min_lon <= max_lon)
+    else:
+        q = q.filter(Restaurant.lat.between(min_lat, max_lat), Restaurant.lon.between(min_lon, max_lon))
+
+    if by_distance:
+        distance = func.haversine(lat, lon, Restaurant.lat, Restaurant.lon)
+        q = q.add_columns(distance.label("distance")).filter(distance <= radius_km)
+        if after is not None:
+            q = q.filter(tuple_(distance, Restaurant.id) > tuple_(*after))
+        return [(row, row.distance) for row in q.order_by(None).order_by(distance, Restaurant.id).limit(limit)]
+
+    found = []
+    for row in q:
+        distance = haversine(lat, lon, row.lat, row.lon)
+        if distance <= radius_km:
+            found.append((row, distance))
+            if limit is not None and len(found) >= limit:
+                break
+    return found
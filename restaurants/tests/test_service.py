@@ -1,13 +1,20 @@
 from datetime import date
-from restaurants.background import check_ratings, recompute_ratings
+from restaurants.background import archive_ratings, archive_ratings_batch, check_ratings, flush_ratings, recompute_ratings, update_restaurant_rating
+from unittest import mock
 import unittest 
 import datetime
 import dateutil
+import json
+import threading
 
 from requests.models import Response
 
 from restaurants.app import create_app 
-from restaurants.utils import get_mock_tables, tables, restaurants, search_mock_restaurants, same_restaurants, same_restaurant
+from restaurants.utils import add_ratings, encode_cursor, get_mock_tables, tables, restaurants, search_mock_restaurants, same_restaurants, same_restaurant
+from restaurants.ratings import rated_filter, rating_events, rating_queue
+from restaurants.cache import MemoryRedis
+from restaurants.orm import catalog_version, db, Rating, RatingArchive
+from sqlalchemy import func
 
 
 restaurant_post_keys= [
@@ -232,7 +239,238 @@ class RestaurantsTests(unittest.TestCase):
                 rests = search_mock_restaurants(restaurants,keys,vals)
                 ret = same_restaurants(json, rests)
                 self.assertIsNone(ret, msg=query)
-            
+
+    def test_search_restaurants_fulltext(self):
+        client = self.app.test_client()
+        queries = {
+            "?menu=pasta%20bolo": [restaurants[3]], # words matched as prefixes, in any order
+            "?menu=bolognese%20PIZZA": [restaurants[3]],
+            "?cuisine_type=italian&name=rest": [restaurants[3]],
+            "?cuisine_type=cuisine_type": restaurants[:3], # same word boundaries of the index
+            "?menu=asta": [], # no match inside the words
+        }
+        for query,rests in queries.items():
+            response = client.get('/restaurants'+query)
+            json = response.get_json()
+            self.assertEqual(response.status_code, 200, msg=json)
+            self.assertIsNone(same_restaurants(json, rests), msg=query)
+
+        # the edits are reflected by the index
+        dup = clone_for_post(restaurants_toaddedit[1], restaurant_post_keys)
+        response = client.put(restaurants_toaddedit[1]["url"], json=dup)
+        self.assertEqual(response.status_code, 200, msg=response.get_json())
+        response = client.get('/restaurants?name=new')
+        self.assertEqual([r["id"] for r in response.get_json()], [2])
+
+        # the most relevant match comes first
+        dup = clone_for_post(restaurants_toaddedit[0], restaurant_post_keys)
+        dup["menu"] = "pizza pizza pizza"
+        response = client.post('/restaurants', json=dup)
+        self.assertEqual(response.status_code, 201, msg=response.get_json())
+        response = client.get('/restaurants?menu=pizza&sort=relevance')
+        self.assertEqual([r["id"] for r in response.get_json()], [5,4])
+        response = client.get('/restaurants?menu=pizza')
+        self.assertEqual([r["id"] for r in response.get_json()], [4,5])
+
+    def test_search_restaurants_near(self):
+        client = self.app.test_client()
+        near = "near=%f,%f" % (restaurants[2]["lat"], restaurants[2]["lon"])
+        queries = {
+            "?%s&radius_km=0.5" % near: [1,3],
+            "?%s&radius_km=1" % near: [1,2,3],
+            "?%s&radius_km=1&sort=distance" % near: [3,1,2],
+            "?%s&radius_km=1&sort=distance&opening_time=11" % near: [3,2],
+            "?%s&radius_km=10&sort=distance&menu=pizza" % near: [4],
+            "?near=-43.7,-10.4&radius_km=10": [],
+        }
+        for query,ids in queries.items():
+            response = client.get('/restaurants'+query)
+            json = response.get_json()
+            self.assertEqual(response.status_code, 200, msg=json)
+            self.assertEqual([r["id"] for r in json], ids, msg=query)
+            for r in json:
+                rest = [rest for rest in restaurants if rest["id"] == r["id"]][0]
+                self.assertIsNone(same_restaurant(rest, r), msg=query)
+                self.assertLessEqual(r["distance"], float(query.split("radius_km=")[1].split("&")[0]))
+
+        # moving a restaurant moves it in the index
+        dup = clone_for_post(restaurants_toaddedit[1], restaurant_post_keys)
+        response = client.put(restaurants_toaddedit[1]["url"], json=dup)
+        self.assertEqual(response.status_code, 200, msg=response.get_json())
+        response = client.get('/restaurants?%s&radius_km=1' % near)
+        self.assertEqual([r["id"] for r in response.get_json()], [1,3])
+
+        for query in ["?near=1&radius_km=1", "?near=100,0&radius_km=1", "?near=1,1", "?radius_km=1", "?sort=distance"]:
+            response = client.get('/restaurants'+query)
+            self.assertEqual(response.status_code, 400, msg=query)
+
+    def get_all_pages(self, client, url):
+        """ Follow the Link headers from url, returns the pages """
+        pages = []
+        while url is not None:
+            response = client.get(url)
+            self.assertIn(response.status_code, [200,204], msg=url)
+            pages.append(response.get_json())
+            link = response.headers.get("Link")
+            url = None
+            if link is not None:
+                self.assertTrue(link.endswith('>; rel="next"'), msg=link)
+                url = link[1:-len('>; rel="next"')]
+        return pages
+
+    def test_restaurants_pagination(self):
+        client = self.app.test_client()
+        near = "near=%f,%f&radius_km=10" % (restaurants[2]["lat"], restaurants[2]["lon"])
+        queries = {
+            "/restaurants?limit=1": [[1],[2],[3],[4]],
+            "/restaurants?limit=3": [[1,2,3],[4]],
+            "/restaurants?limit=4": [[1,2,3,4]],
+            "/restaurants?limit=2&cuisine_type=cuisine&sort=relevance": [[1,2],[3]],
+            "/restaurants?limit=2&%s&sort=distance" % near: [[3,1],[2,4]],
+            "/restaurants?limit=3&%s" % near: [[1,2,3],[4]],
+            "/restaurants/3/tables?limit=2": [[4,5],[6]],
+            "/restaurants/3/tables?limit=1&capacity=3": [[4],[5]],
+        }
+        for url,ids in queries.items():
+            pages = self.get_all_pages(client, url)
+            self.assertEqual([[r["id"] for r in page] for page in pages], ids, msg=url)
+
+        self.app.config["PAGE_SIZE"] = 2
+        for url in ["/restaurants?limit=0", "/restaurants/3/tables?limit=0"]: # the whole list, when asked for
+            response = client.get(url)
+            self.assertNotIn("Link", response.headers, msg=url)
+            self.assertGreater(len(response.get_json()), 2, msg=url)
+        self.app.config["PAGE_SIZE"] = 3
+        for url in ["/restaurants", "/restaurants?cursor=" + encode_cursor([0])]: # PAGE_SIZE by default
+            pages = self.get_all_pages(client, url)
+            self.assertEqual([len(page) for page in pages], [3,1], msg=url)
+        pages = self.get_all_pages(client, "/restaurants/3/tables")
+        self.assertEqual([len(page) for page in pages], [3])
+
+        for url in ["/restaurants?cursor=xxx", "/restaurants?cursor=WzEsMl0=", "/restaurants/3/tables?cursor=xxx"]:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 400, msg=url)
+
+    def test_restaurants_fields(self):
+        client = self.app.test_client()
+        near = "near=%f,%f&radius_km=10" % (restaurants[2]["lat"], restaurants[2]["lon"])
+        queries = {
+            "/restaurants?fields=id,name": ["id","name"],
+            "/restaurants?fields=url,closed_days&sort=relevance&menu=menu": ["url","closed_days"],
+            "/restaurants?fields=name,distance&sort=distance&"+near: ["name","distance"],
+            "/restaurants/3?fields=rating_val,menu": ["rating_val","menu"],
+            "/restaurants/3?fields=id": ["id"],
+        }
+        for url,fields in queries.items():
+            response = client.get(url)
+            json = response.get_json()
+            self.assertEqual(response.status_code, 200, msg=url)
+            for r in json if type(json) == list else [json]:
+                self.assertEqual(sorted(r.keys()), sorted(fields), msg=url)
+
+        response = client.get("/restaurants/3?fields=rating_val,menu")
+        self.assertEqual(response.get_json(), {"rating_val": restaurants[2]["rating_val"], "menu": restaurants[2]["menu"]})
+
+        response = client.get("/restaurants?fields=closed_days")
+        self.assertEqual(response.get_json(), [{"closed_days": r["closed_days"]} for r in restaurants])
+
+        response = client.get("/restaurants?fields=id,opening_mask")
+        self.assertEqual(response.status_code, 400)
+
+    def test_search_cache(self):
+        client = self.app.test_client()
+
+        def stats():
+            response = client.get("/stats")
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()["search_cache"]
+
+        start = stats()
+        for _ in range(3):
+            response = client.get("/restaurants?name=rest&fields=id,name")
+            self.assertEqual(len(response.get_json()), 4)
+            response = client.get("/restaurants?fields=name,id&name=rest") # same normalized query
+            self.assertEqual(len(response.get_json()), 4)
+        self.assertEqual(stats()["hits"] - start["hits"], 5)
+        self.assertEqual(stats()["misses"] - start["misses"], 1)
+
+        # a write invalidates the cache
+        dup = clone_for_post(restaurants_toaddedit[1], restaurant_post_keys)
+        response = client.put(restaurants_toaddedit[1]["url"], json=dup)
+        self.assertEqual(response.status_code, 200)
+        response = client.get("/restaurants?name=rest&fields=id,name")
+        self.assertEqual(response.get_json()[1]["name"], restaurants_toaddedit[1]["name"])
+        self.assertGreater(stats()["invalidations"], start["invalidations"])
+
+        # the rating tasks invalidate the cache too
+        r = restaurants[0]
+        response = client.get(r["url"])
+        self.assertEqual(response.get_json()["rating_num"], 0)
+        response = client.post("%s/rate" % r["url"], json=ratings_toadd[0])
+        self.assertEqual(response.status_code, 202)
+        check_ratings.apply()
+        response = client.get(r["url"])
+        self.assertEqual(response.get_json()["rating_num"], 1)
+
+        # errors are not cached
+        response = client.get("/restaurants/9999")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(stats()["size"], 1) # only restaurants[0] since the last invalidation
+
+    def test_conditional_get(self):
+        client = self.app.test_client()
+        r = restaurants[1]
+        urls = [r["url"], "%s/rate" % r["url"], "%s/tables" % r["url"], tables[1]["url"], "/restaurants", "/restaurants?name=rest&limit=2"]
+
+        etags = {}
+        for url in urls:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200, msg=url)
+            etags[url] = response.headers["ETag"]
+            response = client.get(url, headers={"If-None-Match": etags[url]})
+            self.assertEqual(response.status_code, 304, msg=url)
+            self.assertEqual(response.headers["ETag"], etags[url])
+            self.assertEqual(response.get_data(), b"")
+            response = client.get(url, headers={"If-None-Match": '"0"'})
+            self.assertEqual(response.status_code, 200, msg=url)
+
+        # a write changes the versions of the written records and of the pages containing them
+        dup = clone_for_post(r, restaurant_post_keys)
+        response = client.put(r["url"], json=dup)
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            version = catalog_version()
+        dup = clone_for_post(tables[1], table_post_keys)
+        response = client.put(tables[1]["url"], json=dup)
+        self.assertEqual(response.status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(catalog_version(), version) # the tables do not drop the caches of the restaurants
+        for url in urls:
+            response = client.get(url, headers={"If-None-Match": etags[url]})
+            self.assertEqual(response.status_code, 200, msg=url)
+            self.assertNotEqual(response.headers["ETag"], etags[url])
+
+        # the rating tasks change the version of the restaurant
+        url = "%s/rate" % restaurants[0]["url"]
+        etag = client.get(url).headers["ETag"]
+        response = client.post(url, json=ratings_toadd[0])
+        self.assertEqual(response.status_code, 202)
+        check_ratings.apply()
+        response = client.get(url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()["ratings"], 1)
+
+    def test_export_restaurants(self):
+        client = self.app.test_client()
+        for chunk in [1, 3, 4, 100]:
+            self.app.config["EXPORT_CHUNK"] = chunk
+            response = client.get('/restaurants/export')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "application/x-ndjson")
+            lines = response.get_data(as_text=True).splitlines()
+            ret = same_restaurants([json.loads(line) for line in lines], restaurants)
+            self.assertIsNone(ret, msg=chunk)
+
     def test_post_restaurants(self):
         client = self.app.test_client()
         dup = clone_for_post(restaurants_toaddedit[0], restaurant_post_keys)
@@ -372,6 +610,190 @@ class RestaurantsTests(unittest.TestCase):
         self.assertEqual(json["rating"], ratings_toadd[0]["rating"], msg =json)
         self.assertEqual(json["ratings"], 1, msg =json)
 
+    def test_check_ratings_batches(self):
+        client = self.app.test_client()
+        self.app.config["RATINGS_BATCH"] = 3
+        votes = {1: [], 3: []}
+        histograms = dict([(rest_id, client.get("/restaurants/%d/rate?detail=histogram" % rest_id).get_json()["histogram"]) for rest_id in votes])
+        for rater_id in range(1, 11):
+            for rest_id,votes_list in votes.items():
+                rating = (rater_id + rest_id) % 5 + 1
+                response = client.post("/restaurants/%d/rate" % rest_id, json={"rater_id": rater_id, "rating": rating})
+                self.assertEqual(response.status_code, 202, msg=response.get_data())
+                votes_list.append(rating)
+
+        self.assertEqual(check_ratings.apply().get(), 20)
+        self.assertEqual(check_ratings.apply().get(), 0) # all marked
+
+        for r in [restaurants[0], restaurants[2]]:
+            expected = (round(r["rating_val"]*r["rating_num"]) + sum(votes[r["id"]])) / (r["rating_num"] + len(votes[r["id"]]))
+            json = client.get("%s/rate" % r["url"]).get_json()
+            self.assertAlmostEqual(json["rating"], expected, msg=json)
+            self.assertEqual(json["ratings"], r["rating_num"] + len(votes[r["id"]]), msg=json)
+            json = client.get("%s/rate?detail=histogram" % r["url"]).get_json()
+            self.assertEqual(json["histogram"], [n + votes[r["id"]].count(value) for value,n in enumerate(histograms[r["id"]])], msg=json)
+
+    def test_recompute_ratings_chunks(self):
+        client = self.app.test_client()
+        self.app.config["RECOMPUTE_CHUNK"] = 1
+        votes = {1: [], 2: [], 4: []}
+        for rater_id in range(1, 6):
+            for rest_id,votes_list in votes.items():
+                rating = (rater_id * rest_id) % 5 + 1
+                response = client.post("/restaurants/%d/rate" % rest_id, json={"rater_id": rater_id, "rating": rating})
+                if response.status_code == 202: # some users already rated the restaurant in the fake data
+                    votes_list.append(rating)
+
+        report = recompute_ratings.apply().get()
+        self.assertEqual(report["restaurants"], len(votes))
+        self.assertGreaterEqual(report["ratings"], sum([len(v) for v in votes.values()]))
+        self.assertGreaterEqual(report["seconds"], 0)
+        self.assertEqual(check_ratings.apply().get(), 0) # all marked
+        self.assertEqual(recompute_ratings.apply().get()["fixed"], 0) # already consistent
+
+        json = client.get("/restaurants/1/rate").get_json()
+        self.assertAlmostEqual(json["rating"], sum(votes[1]) / len(votes[1]), msg=json)
+        self.assertEqual(json["ratings"], len(votes[1]), msg=json)
+        self.assertNotIn("histogram", json)
+
+        json = client.get("/restaurants/1/rate?detail=histogram").get_json()
+        self.assertEqual(json["histogram"], [votes[1].count(value) for value in range(6)], msg=json)
+        self.assertEqual(client.get("/restaurants/1/rate?detail=other").status_code, 400)
+
+    def test_recompute_ratings_partitions(self):
+        client = self.app.test_client()
+        for rest_id in [1, 2, 4]:
+            for rater_id in range(1, 4):
+                client.post("/restaurants/%d/rate" % rest_id, json={"rater_id": rater_id, "rating": rater_id})
+
+        # eager execution: the chord of the partitions runs in this process
+        self.app.config["RECOMPUTE_PARTITION"] = 1
+        report = recompute_ratings.apply().get()
+        with self.app.app_context():
+            first,last = db.session.query(func.min(Rating.restaurant_id), func.max(Rating.restaurant_id)).first()
+        self.assertEqual(report["partitions"], last - first + 1) # one for every restaurant id
+        self.assertGreaterEqual(report["restaurants"], 3)
+
+        self.app.config["RECOMPUTE_PARTITION"] = 10000
+        single = recompute_ratings.apply().get()
+        self.assertEqual(single["partitions"], 1)
+        self.assertEqual((single["ratings"], single["restaurants"], single["fixed"]), (report["ratings"], report["restaurants"], 0))
+
+    def test_archive_ratings(self):
+        client = self.app.test_client()
+        url = "%s/rate" % restaurants[0]["url"]
+        self.assertEqual(client.post(url, json={"rater_id": 50, "rating": 4}).status_code, 202)
+        self.assertEqual(check_ratings.apply().get(), 1)
+        before = client.get(url + "?detail=histogram").get_json()
+
+        self.assertEqual(archive_ratings.apply().get(), 0) # the new ratings are kept
+        with self.app.app_context():
+            # the scan of check_ratings reads only the unmarked ratings
+            plan = " ".join([str(row) for row in db.session.execute("EXPLAIN QUERY PLAN SELECT rater_id, restaurant_id FROM Rating WHERE marked = 0")])
+            self.assertIn("ix_Rating_unmarked", plan)
+
+            self.assertGreaterEqual(archive_ratings_batch(datetime.datetime.utcnow() + datetime.timedelta(seconds=1), 2), 1)
+            while archive_ratings_batch(datetime.datetime.utcnow() + datetime.timedelta(seconds=1), 2) > 0:
+                pass
+            self.assertEqual(db.session.query(Rating).filter(Rating.marked == True).count(), 0)
+            self.assertEqual(db.session.query(RatingArchive).filter_by(restaurant_id=restaurants[0]["id"], rater_id=50).count(), 1)
+            self.assertEqual(add_ratings([(restaurants[0]["id"], 50, 1)]), 0) # an archived duplicate
+
+        # the archived ratings are still duplicates and still counted
+        response = client.post(url, json={"rater_id": 50, "rating": 4})
+        self.assertEqual(response.status_code, 400, msg=response.get_json())
+        self.assertEqual(recompute_ratings.apply().get()["fixed"], 0)
+        self.assertEqual(client.get(url + "?detail=histogram").get_json(), before)
+
+    def test_rating_queue(self):
+        client = self.app.test_client()
+        rating_queue.configure(MemoryRedis()) # write-behind mode
+        url = "%s/rate" % restaurants[0]["url"]
+        for _ in range(2): # the duplicate is accepted while the first is queued
+            response = client.post(url, json={"rater_id": 7, "rating": 4})
+            self.assertEqual(response.status_code, 202, msg=response.get_data())
+        self.assertEqual(client.get("/stats").get_json()["rating_queue"]["size"], 2)
+        self.assertEqual(client.get(url).get_json()["ratings"], 0) # not inserted yet
+
+        self.assertEqual(flush_ratings.apply().get(), 1) # the duplicate is ignored
+        self.assertEqual(client.get("/stats").get_json()["rating_queue"]["size"], 0)
+        response = client.post(url, json={"rater_id": 7, "rating": 4})
+        self.assertEqual(response.status_code, 400, msg=response.get_data())
+
+        # the flushes running at the same time share the ratings, none is lost
+        self.app.config["RATINGS_BATCH"] = 3
+        for rater_id in range(100, 160):
+            self.assertEqual(client.post(url, json={"rater_id": rater_id, "rating": 3}).status_code, 202)
+        inserted = []
+        held = []
+        barrier = threading.Barrier(2)
+        def add_together(ratings, seen=threading.local()):
+            if getattr(seen, "waited", False):
+                return add_ratings(ratings)
+            seen.waited = True
+            held.append(set(ratings))
+            barrier.wait(5) # both flushers hold a batch
+            count = add_ratings(ratings)
+            barrier.wait(5) # and both stored it before removing it
+            return count
+        with mock.patch("restaurants.background.add_ratings", add_together):
+            flushers = [threading.Thread(target=lambda: inserted.append(flush_ratings.apply().get())) for _ in range(2)]
+            for flusher in flushers:
+                flusher.start()
+            for flusher in flushers:
+                flusher.join()
+        self.assertEqual(held[0] & held[1], set()) # not the same one
+        self.assertEqual(sum(inserted), 60)
+        self.assertEqual(client.get("/stats").get_json()["rating_queue"]["size"], 0)
+        with self.app.app_context():
+            self.assertEqual(db.session.query(Rating).filter(Rating.restaurant_id == restaurants[0]["id"], Rating.rater_id >= 100).count(), 60)
+
+        class Unreachable:
+            def rpush(self, *args):
+                raise ConnectionError("redis is down")
+        rating_queue.configure(Unreachable())
+        response = client.post(url, json={"rater_id": 8, "rating": 2}) # written at once
+        self.assertEqual(response.status_code, 202, msg=response.get_data())
+        response = client.post(url, json={"rater_id": 8, "rating": 2})
+        self.assertEqual(response.status_code, 400, msg=response.get_data())
+        self.assertEqual(rating_queue.stats()["errors"], 1)
+
+    def test_rating_events(self):
+        client = self.app.test_client()
+        rating_queue.configure(MemoryRedis()) # write-behind mode
+        rating_events.configure(MemoryRedis(), 2)
+        with mock.patch.object(update_restaurant_rating, "apply_async") as scheduled:
+            for rater_id in range(1, 4): # a burst for the same restaurant
+                response = client.post("/restaurants/1/rate", json={"rater_id": rater_id, "rating": rater_id})
+                self.assertEqual(response.status_code, 202, msg=response.get_data())
+            response = client.post("/restaurants/3/rate", json={"rater_id": 1, "rating": 5})
+            self.assertEqual(response.status_code, 202, msg=response.get_data())
+            self.assertEqual(scheduled.call_count, 0) # in write-behind mode, once inserted
+            self.assertEqual(flush_ratings.apply().get(), 4)
+            self.assertEqual(sorted([c.args for c in scheduled.call_args_list]), [((1,),), ((3,),)])
+            self.assertEqual(scheduled.call_args.kwargs, {"countdown": 2, "retry": False}) # the request does not wait for the broker
+
+            # one update counts all the ratings of the burst
+            self.assertEqual(update_restaurant_rating.apply((1,)).get(), 3)
+            self.assertEqual(client.get("/restaurants/1/rate").get_json(), {"rating": 2, "ratings": 3})
+            self.assertEqual(update_restaurant_rating.apply((1,)).get(), 0) # nothing to do
+
+            rating_queue.configure(None) # the ratings written at once schedule the update themselves
+            response = client.post("/restaurants/1/rate", json={"rater_id": 4, "rating": 1})
+            self.assertEqual(scheduled.call_count, 3) # released by the update
+            response = client.post("/restaurants/1/rate", json={"rater_id": 5, "rating": 1})
+            self.assertEqual(scheduled.call_count, 3)
+            self.assertEqual(client.get("/stats").get_json()["rating_events"]["coalesced"], 1)
+
+            scheduled.side_effect = ConnectionError("broker is down")
+            response = client.post("/restaurants/2/rate", json={"rater_id": 5, "rating": 1})
+            self.assertEqual(response.status_code, 202, msg=response.get_data())
+            scheduled.side_effect = None
+            response = client.post("/restaurants/2/rate", json={"rater_id": 6, "rating": 1})
+            self.assertEqual(scheduled.call_count, 5) # the claim has been released
+
+        self.assertEqual(check_ratings.apply().get(), 5) # the updates not run yet
+
     def test_post_restaurant_rate_failures(self):
         client = self.app.test_client()
         r = restaurants[1]
@@ -379,6 +801,13 @@ class RestaurantsTests(unittest.TestCase):
         response = client.post("%s/rate" % r["url"], json=ratings_toadd[1])
         self.assertEqual(response.status_code, 400, msg=response.get_data())
 
+        # a filter missing the pair lets the duplicate through, the failed insert is checked in the database
+        rated_filter.configure(1000, 0.01, MemoryRedis())
+        rated_filter.warm([])
+        rating_queue.configure(None)
+        response = client.post("%s/rate" % r["url"], json=ratings_toadd[1])
+        self.assertEqual(response.status_code, 400, msg=response.get_data())
+
         response = client.get("%s/rate" % r["url"])
         json = response.get_json()
         self.assertEqual(response.status_code, 200, msg=json)
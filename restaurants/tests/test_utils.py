@@ -1,13 +1,64 @@
 from datetime import date
 import unittest 
 import datetime
+import http.server
+import os
+import requests
+import threading
+import tempfile
+import time
 
 from restaurants.utils import *
 
+from restaurants.search import opening_mask, init_opening_index
+
+from restaurants.orm import fold_ratings, init_rating_aggregates
+
+from restaurants.cache import BookingsCache, LRUCache, EntityCache, MemoryRedis, bookings_cache
+
+from restaurants.ratings import RatedFilter, RatingQueue
+
+from restaurants.scheduler import Scheduler
+
+from restaurants.http_client import CircuitBreaker, HttpClient, bookings_breaker, http_client
+
 from restaurants.app import create_app 
 
 from flask import current_app
 
+class StubBookings(http.server.BaseHTTPRequestHandler):
+    """ A local bookings service without bookings, keeping the connections alive
+
+    /slow answers after 0.2 seconds, /stall-once answers after 0.5 seconds the first time
+    """
+    protocol_version = "HTTP/1.1"
+    stalled = False
+    headers_received = None # of the last request
+
+    def do_GET(self):
+        StubBookings.headers_received = dict(self.headers)
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+        if self.path.startswith("/stall-once") and not StubBookings.stalled:
+            StubBookings.stalled = True
+            time.sleep(0.5)
+        body = b"[]"
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_bookings():
+    """ Start the stub bookings service in a thread, returns the server and its url """
+    StubBookings.stalled = False
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), StubBookings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d" % server.server_port
+
 class RestaurantsUtilsTests(unittest.TestCase):
     """ Tests utility functions with and without mocks """
 
@@ -32,4 +83,439 @@ class RestaurantsUtilsTests(unittest.TestCase):
         now = datetime.datetime.now()
 
         with self.app.app_context():
-            pass
\ No newline at end of file
+            pass
+
+    def test_lru_cache(self):
+        cache = LRUCache(2, 60)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), (True, 1))
+        cache.put("c", 3) # evicts b, the least recently used
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("c"), (True, 3))
+
+        cache.check_version(lambda: 1)
+        self.assertEqual(cache.get("a"), (False, None))
+        cache.put("a", 1)
+        cache.check_version(lambda: 1)
+        self.assertEqual(cache.get("a"), (True, 1))
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["evictions"], stats["invalidations"]), (3, 2, 1, 1))
+
+        # the version is read at most every version_interval seconds, or after expire_version
+        cache.configure(2, 60, 60)
+        cache.check_version(lambda: 1)
+        cache.put("a", 1)
+        cache.check_version(lambda: self.fail("checked again"))
+        self.assertEqual(cache.get("a"), (True, 1))
+        cache.expire_version()
+        cache.check_version(lambda: 2)
+        self.assertEqual(cache.get("a"), (False, None))
+
+        cache.configure(2, 0) # entries expire immediately
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), (False, None))
+
+        cache.configure(0, 60) # disabled
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), (False, None))
+
+    def test_entity_cache(self):
+        redis = MemoryRedis() # shared by two processes
+        first, second = EntityCache(), EntityCache()
+        first.configure(redis)
+        second.configure(redis)
+        loads = []
+        def loader():
+            loads.append(1)
+            return {"id": 1, "name": "Restaurant 1"}
+
+        self.assertEqual(first.get("restaurant", 1, loader), {"id": 1, "name": "Restaurant 1"})
+        self.assertEqual(second.get("restaurant", 1, loader), {"id": 1, "name": "Restaurant 1"}) # read from redis
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(second.stats()["remote_hits"], 1)
+
+        first.invalidate("restaurant", 1) # drops the local copy of second too
+        self.assertEqual(second.get("restaurant", 1, loader), {"id": 1, "name": "Restaurant 1"})
+        self.assertEqual(len(loads), 2)
+
+        # a record loaded while it is written is returned, but it is not kept
+        def racing():
+            first.invalidate("restaurant", 3)
+            return {"id": 3, "name": "old"}
+        self.assertEqual(second.get("restaurant", 3, racing), {"id": 3, "name": "old"})
+        self.assertEqual(first.get("restaurant", 3, lambda: {"id": 3, "name": "new"}), {"id": 3, "name": "new"})
+        self.assertEqual(second.get("restaurant", 3, lambda: {"id": 3, "name": "new"}), {"id": 3, "name": "new"})
+
+        self.assertIsNone(first.get("restaurant", 2, lambda: None))
+        self.assertIsNone(redis.get("restaurants:restaurant:2")) # the missing records are not cached
+
+        disabled = EntityCache()
+        self.assertFalse(disabled.enabled)
+        disabled.get("restaurant", 1, loader)
+        self.assertEqual(len(loads), 3)
+
+    def test_rating_queue_claims(self):
+        queue = RatingQueue()
+        queue.configure(MemoryRedis())
+        for rater_id in range(1, 6):
+            queue.push(1, rater_id, 3)
+        first,ratings = queue.claim(2)
+        second,others = queue.claim(2)
+        self.assertEqual((ratings, others), ([(1, 1, 3), (1, 2, 3)], [(1, 3, 3), (1, 4, 3)])) # never the same ratings
+        queue.ack(first, 2)
+        queue.release(second) # not stored, back at the head
+        self.assertEqual(queue.stats()["size"], 3)
+
+        third,ratings = queue.claim(10)
+        self.assertEqual(ratings, [(1, 3, 3), (1, 4, 3), (1, 5, 3)])
+        self.assertEqual(queue.requeue_expired(), 0)
+        self.assertEqual(queue.requeue_expired(timeout=0), 1) # the flush holding it died
+        self.assertEqual(queue.claim(10)[1], ratings)
+        self.assertEqual(queue.stats()["flushed"], 2)
+
+    def test_rated_filter(self):
+        pairs = [(rest_id, rater_id) for rest_id in range(1, 11) for rater_id in range(1, 101)]
+        missing = [(rest_id, rater_id) for rest_id in range(1, 11) for rater_id in range(101, 1101)]
+
+        rated = RatedFilter()
+        self.assertTrue(rated.might_contain(1, 1)) # disabled until warmed
+        rated.configure(1000, 0.01)
+        self.assertEqual(rated.warm(pairs), 0) # and without redis (the processes would not see the pairs of the others)
+        self.assertTrue(rated.might_contain(1, 2000))
+        rated.configure(1000, 0.01, MemoryRedis())
+        self.assertEqual((rated.size, rated.hashes), (9586, 7))
+        self.assertEqual(rated.warm(pairs), len(pairs))
+        for rest_id,rater_id in pairs: # no false negatives
+            self.assertTrue(rated.might_contain(rest_id, rater_id))
+        false_positives = len([pair for pair in missing if rated.might_contain(*pair)])
+        self.assertLess(false_positives / len(missing), 0.02)
+        rated.add(1, 2000)
+        self.assertTrue(rated.might_contain(1, 2000))
+
+        # in redis the filter is shared and warmed only once
+        redis = MemoryRedis()
+        first, second = RatedFilter(), RatedFilter()
+        first.configure(1000, 0.01, redis)
+        second.configure(1000, 0.01, redis)
+        self.assertEqual(first.warm(lambda: pairs), len(pairs))
+        loads = []
+        def load():
+            loads.append(1)
+            return pairs
+        self.assertEqual((second.warm(load), len(loads)), (0, 0)) # already warmed
+        self.assertEqual(len([pair for pair in missing if second.might_contain(*pair)]), false_positives) # same bits
+        first.add(1, 2000) # published to the other processes
+        self.assertTrue(second.might_contain(1, 2000))
+
+        # the bits lost by redis are warmed again, the added pairs are kept
+        redis.delete(first.key)
+        second.synced -= RatedFilter.SYNC
+        self.assertTrue(second.might_contain(1, 2000))
+        self.assertEqual((second.stats()["rewarmed"], second.stats()["errors"], len(loads)), (1, 0, 1))
+        third = RatedFilter()
+        third.configure(1000, 0.01, redis)
+        self.assertEqual(third.warm(load), 0)
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(all([third.might_contain(*pair) for pair in pairs + [(1, 2000)]]))
+
+        # the bits are merged from redis (a missed message)
+        redis.setbit(first.key, first._positions(2, 3000)[0], 1)
+        self.assertFalse(first.might_contain(2, 3000))
+        for pos in first._positions(2, 3000):
+            redis.setbit(first.key, pos, 1)
+        first.synced -= RatedFilter.SYNC
+        self.assertTrue(first.might_contain(2, 3000))
+
+    def test_scheduler(self):
+        lock = os.path.join(tempfile.mkdtemp(), "scheduler.lock")
+        calls = []
+        first, second = Scheduler(), Scheduler()
+        for scheduler in [first, second]:
+            scheduler.configure(lock, jitter=0.5)
+            scheduler.add("job", 0.01, lambda: calls.append(1))
+            scheduler.add("failing", 0.01, lambda: 1/0)
+        time.sleep(0.02) # after the longest jittered interval
+        self.assertEqual(first.run_pending(), 2)
+        self.assertEqual(second.run_pending(), 0) # only the process holding the lock runs the jobs
+        self.assertEqual((len(calls), first.runs["job"], first.errors, second.skipped), (1, 1, 1, 2))
+
+        # the thread runs them until stopped, then the lock is free
+        first.tick = 0.01
+        first.start()
+        time.sleep(0.2)
+        first.stop()
+        self.assertGreater(first.stats()["runs"]["job"], 2)
+        self.assertFalse(first.stats()["enabled"])
+        time.sleep(0.02)
+        self.assertEqual(second.run_pending(), 2)
+
+    def test_http_client(self):
+        server,url = start_stub_bookings()
+        try:
+            client = HttpClient()
+            client.configure(pool_size=2, retries=2, backoff=0.001)
+            for _ in range(5):
+                self.assertEqual(client.get(url + "/bookings?rest=1", timeout=2).json(), [])
+            stats = client.stats()
+            self.assertEqual((stats["requests"], stats["connections"], stats["reused"]), (5, 1, 4)) # kept alive
+
+            # more calls at once than pooled connections
+            threads = [threading.Thread(target=client.get, args=(url + "/slow", 2)) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = client.stats()
+            self.assertEqual((stats["max_in_flight"], stats["saturated"], stats["in_flight"]), (4, 2, 0))
+
+            # get_from uses the pooled client of the process
+            self.app.config["BOOK_SERVICE_URL"] = url
+            self.app.config["USE_MOCKS"] = False
+            with self.app.app_context():
+                self.assertEqual(get_future_bookings(1), ([], 200))
+                self.assertEqual(get_future_bookings(1, 2), ([], 200))
+            self.assertEqual((http_client.stats()["connections"], http_client.stats()["reused"]), (1, 1))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # the connection errors are retried, then raised
+        client.configure(pool_size=2, retries=2, backoff=0.001)
+        with self.assertRaises(requests.ConnectionError):
+            client.get(url, timeout=1)
+        self.assertEqual((client.stats()["retries"], client.stats()["errors"]), (2, 1))
+
+        # but not past the deadline
+        client.configure(pool_size=2, retries=5, backoff=0.5)
+        start = time.monotonic()
+        with self.assertRaises(requests.ConnectionError):
+            client.get(url, timeout=1, deadline=start + 0.1)
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(client.stats()["retries"], 0)
+
+    def test_adaptive_timeout(self):
+        server,url = start_stub_bookings()
+        host = url[len("http://"):]
+        try:
+            client = HttpClient()
+            client.configure(retries=0, timeout_percentile=99, timeout_multiplier=2, min_timeout=0.05)
+            self.assertEqual(client.timeout_for(host, 2), 2) # the latencies are not known yet
+            for _ in range(HttpClient.MIN_SAMPLES):
+                client.get(url + "/bookings", 2)
+            self.assertLess(client.timeout_for(host, 2), 0.2)
+            self.assertEqual(client.stats()["latency"][host]["samples"], HttpClient.MIN_SAMPLES)
+            # a slow call is given up early, then sent again with the longest timeout
+            self.assertEqual(client.get(url + "/slow", 2).json(), [])
+            self.assertEqual((client.stats()["extended"], client.stats()["errors"]), (1, 0))
+            self.assertEqual(client.stats()["latency"][host]["samples"], HttpClient.MIN_SAMPLES + 2) # the timeouts are counted
+            start = time.monotonic()
+            with self.assertRaises(requests.Timeout): # slower than the longest timeout, that bounds the whole call
+                client.get(url + "/slow", 0.15)
+            self.assertLess(time.monotonic() - start, 0.19)
+            start = time.monotonic()
+            with self.assertRaises(requests.Timeout): # not waited for past the deadline
+                client.get(url + "/slow", 2, deadline=start + 0.1)
+            self.assertLess(time.monotonic() - start, 0.15)
+
+            # the duplicate of a slow call answers first
+            client.configure(retries=0, hedge_percentile=95)
+            for _ in range(HttpClient.MIN_SAMPLES):
+                client.get(url + "/bookings", 2)
+            start = time.monotonic()
+            self.assertEqual(client.get(url + "/stall-once", 2).json(), [])
+            self.assertLess(time.monotonic() - start, 0.4)
+            self.assertEqual((client.stats()["hedged"], client.stats()["hedge_wins"], client.stats()["errors"]), (1, 1, 0))
+
+            # out of budget: the slow call is waited for
+            client.configure(retries=0, hedge_percentile=95, hedge_budget=0)
+            for _ in range(HttpClient.MIN_SAMPLES):
+                client.get(url + "/bookings", 2)
+            StubBookings.stalled = False
+            start = time.monotonic()
+            self.assertEqual(client.get(url + "/stall-once", 2).json(), [])
+            self.assertGreaterEqual(time.monotonic() - start, 0.5)
+            self.assertEqual((client.stats()["hedged"], client.stats()["hedge_skipped"]), (0, 1))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_request_deadline(self):
+        self.assertIsNone(parse_deadline({}))
+        self.assertIsNone(parse_deadline({"grpc-timeout": "2 seconds", "X-Request-Deadline": "tomorrow"})) # ignored
+        self.assertAlmostEqual(parse_deadline({"grpc-timeout": "2S"}) - time.monotonic(), 2, places=1)
+        self.assertAlmostEqual(parse_deadline({"grpc-timeout": "2S", "X-Request-Deadline": str(time.time() + 1)}) - time.monotonic(), 1, places=1)
+
+        server,url = start_stub_bookings()
+        try:
+            self.app.config["USE_MOCKS"] = False
+            self.app.config["BOOK_SERVICE_URL"] = url
+            client = self.app.test_client()
+            # already expired: answered at once, without calling the bookings service
+            response = client.delete("/restaurants/1", headers={"grpc-timeout": "0m"})
+            self.assertEqual(response.status_code, 504, msg=response.get_json())
+            self.assertEqual(http_client.stats()["requests"], 0)
+
+            # expired while waiting for the bookings service, that is not counted as its failure
+            self.app.config["BOOK_SERVICE_URL"] = url + "/slow"
+            start = time.monotonic()
+            response = client.delete("/restaurants/1", headers={"X-Request-Deadline": "%.3f" % (time.time() + 0.1)})
+            self.assertEqual(response.status_code, 504, msg=response.get_json())
+            self.assertLess(time.monotonic() - start, 0.2)
+            self.assertEqual(bookings_breaker.stats()["failures"], 0)
+
+            # the remaining budget is forwarded
+            self.app.config["BOOK_SERVICE_URL"] = url
+            response = client.delete("/restaurants/1", headers={"grpc-timeout": "5S"})
+            self.assertEqual(response.status_code, 204, msg=response.get_data())
+            self.assertLessEqual(int(StubBookings.headers_received["grpc-timeout"][:-1]), 5000)
+            self.assertLessEqual(float(StubBookings.headers_received["X-Request-Deadline"]), time.time() + 5)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker("test")
+        breaker.configure(failures=2, reset=0.05, trials=1)
+        late = breaker.allow() # a slow call, allowed while closed
+        for _ in range(2):
+            ticket = breaker.allow()
+            self.assertIsNotNone(ticket)
+            breaker.record(ticket, False)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertIsNone(breaker.allow()) # fail fast
+        breaker.record(late, True) # ignored, it was allowed before the breaker opened
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        time.sleep(0.06)
+        probe = breaker.allow()
+        self.assertIsNotNone(probe)
+        self.assertIsNone(breaker.allow()) # one at a time
+        breaker.record(late, True) # not a probe
+        self.assertIsNone(breaker.allow())
+        breaker.record(probe, False) # opens again
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        time.sleep(0.06)
+        breaker.record(breaker.allow(), True)
+        self.assertEqual(breaker.stats(), {"state": "closed", "failures": 0, "threshold": 2, "reset": 0.05, "opened": 2, "rejected": 3})
+
+        # the calls to the bookings service fail at once while the breaker is open
+        server,url = start_stub_bookings()
+        server.shutdown()
+        server.server_close()
+        self.app.config["BOOK_SERVICE_URL"] = url
+        self.app.config["USE_MOCKS"] = False
+        bookings_breaker.configure(failures=2, reset=60)
+        with self.app.app_context():
+            for _ in range(3):
+                self.assertEqual(get_future_bookings(1), (None, -1))
+        self.assertEqual(bookings_breaker.stats()["state"], "open")
+        self.assertEqual((http_client.stats()["requests"], bookings_breaker.stats()["rejected"]), (2, 1))
+
+    def test_bookings_cache(self):
+        # two processes sharing redis
+        redis = MemoryRedis()
+        first, second = BookingsCache(), BookingsCache()
+        first.configure(10, 60, redis)
+        second.configure(10, 60, redis)
+        loads = []
+        def loader(code=200):
+            loads.append(1)
+            return [], code
+        for cache in [first, second]:
+            for table_id in [None, 1, 2]:
+                cache.get(1, table_id, loader)
+                cache.get(1, table_id, loader)
+            cache.get(2, None, loader)
+        self.assertEqual(len(loads), 8)
+        self.assertEqual(first.get(3, None, lambda: loader(-1)), ([], -1))
+        self.assertEqual(first.get(3, None, lambda: loader(-1)), ([], -1)) # the errors are not cached
+        self.assertEqual(len(loads), 10)
+
+        first.invalidate(1, 2) # the restaurant and the table, in both processes
+        self.assertEqual([sorted(cache.local.entries, key=str) for cache in [first, second]], [[(1, 1), (2, None)]] * 2)
+        second.invalidate(1)
+        self.assertEqual([list(cache.local.entries) for cache in [first, second]], [[(2, None)]] * 2)
+
+        # an answer loaded while the bookings change is returned, but not kept
+        def racing():
+            second.invalidate(2)
+            return [], 200
+        self.assertEqual(first.get(2, 5, racing), ([], 200))
+        self.assertEqual(list(first.local.entries), [])
+        first.get(2, 5, loader)
+        self.assertEqual(list(first.local.entries), [(2, 5)])
+
+        # the conflict checks call the bookings service once, until it notifies a change
+        server,url = start_stub_bookings()
+        try:
+            self.app.config["BOOK_SERVICE_URL"] = url
+            self.app.config["USE_MOCKS"] = False
+            self.assertFalse(bookings_cache.enabled) # without redis
+            bookings_cache.configure(self.app.config["BOOKINGS_CACHE_SIZE"], self.app.config["BOOKINGS_CACHE_TTL"], MemoryRedis())
+            client = self.app.test_client()
+            with self.app.app_context():
+                for _ in range(3):
+                    self.assertEqual(get_future_bookings(1, 2), ([], 200))
+                self.assertEqual(http_client.stats()["requests"], 1)
+                self.assertEqual(client.post("/restaurants/1/bookings/changed?table=2").status_code, 204)
+                self.assertEqual(get_future_bookings(1, 2), ([], 200))
+                self.assertEqual(get_future_bookings(1, 3), ([], 200))
+                self.assertEqual(http_client.stats()["requests"], 3)
+            self.assertEqual(client.get("/stats").get_json()["bookings_cache"]["notified"], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_opening_mask(self):
+        self.assertEqual(opening_mask(None, None, None, None, ""), 0)
+        self.assertEqual(opening_mask(10, 12, None, None, [1,7]), 0b111<<10 | 1<<24 | 1<<30)
+        self.assertEqual(opening_mask(None, None, 20, 25, "2"), 0b1111<<20 | 1<<25) # after midnight is not counted
+
+    def test_opening_index_backfill(self):
+        with self.app.app_context():
+            # simulate a database created before the column existed
+            db.session.execute("ALTER TABLE restaurant DROP COLUMN opening_mask")
+            db.session.commit()
+
+            self.assertEqual(init_opening_index(), len(restaurants))
+            db.session.execute("CREATE INDEX ix_restaurant_opening_mask ON restaurant (opening_mask)") # of the older versions
+            db.session.commit()
+            self.assertEqual(init_opening_index(), 0)
+            self.assertNotIn("ix_restaurant_opening_mask", [row[1] for row in db.session.execute('PRAGMA index_list("restaurant")')])
+            for r in restaurants:
+                mask = db.session.query(Restaurant.opening_mask).filter(Restaurant.id == r["id"]).scalar()
+                self.assertEqual(mask, opening_mask(r["first_opening_hour"], r["first_closing_hour"], 
+                    r["second_opening_hour"], r["second_closing_hour"], r["closed_days"]))
+
+        response = self.app.test_client().get("/restaurants?opening_time=11&open_day=1")
+        self.assertEqual([r["id"] for r in response.get_json()], [3,4])
+
+    def test_rating_sums_backfill(self):
+        with self.app.app_context():
+            db.session.add_all([Rating(rater_id=i, restaurant_id=1, rating=i, marked=i < 4) for i in range(1, 6)])
+            db.session.query(Restaurant).filter(Restaurant.id == 1).update({Restaurant.rating_num: 3, Restaurant.rating_val: 2}, synchronize_session=False)
+            db.session.commit()
+            # simulate a database created before the columns existed
+            db.session.execute("ALTER TABLE restaurant DROP COLUMN rating_sum")
+            db.session.execute("ALTER TABLE restaurant DROP COLUMN rating_2")
+            db.session.commit()
+
+            self.assertEqual(init_rating_aggregates(), len(restaurants))
+            self.assertEqual(init_rating_aggregates(), 0)
+            rest = db.session.query(Restaurant).filter(Restaurant.id == 1).first()
+            self.assertEqual((rest.rating_sum, rest.rating_num, rest.rating_val), (6, 3, 2)) # only the marked ratings
+            self.assertEqual(load_rating_histogram(1), [0, 1, 1, 1, 0, 0])
+            rest = db.session.query(Restaurant).filter(Restaurant.id == 3).first() # counted ratings no longer in the table
+            self.assertEqual((rest.rating_sum, rest.rating_num, rest.rating_val), (418, 123, 3.4))
+
+            # the ratings are folded in (or out) exactly
+            db.session.query(Restaurant).filter(Restaurant.id == 1).update(fold_ratings(4, 1, [0, 0, 0, 0, 1, 0]), synchronize_session=False)
+            db.session.commit()
+            self.assertEqual(load_rating_histogram(1), [0, 1, 1, 1, 1, 0])
+            db.session.query(Restaurant).filter(Restaurant.id == 1).update(fold_ratings(-10, -4, [0, -1, -1, -1, -1, 0]), synchronize_session=False)
+            db.session.commit()
+            rest = db.session.query(Restaurant).filter(Restaurant.id == 1).first()
+            self.assertEqual((rest.rating_sum, rest.rating_num, rest.rating_val), (0, 0, 0))
+            self.assertEqual(load_rating_histogram(1), [0] * 6)
\ No newline at end of file
@@ -3,14 +3,34 @@ import logging
 import random
 import os
 import traceback
-import requests
+import base64
+import hashlib
+import json
+import re
+import time
 
-from flask import current_app
+from flask import current_app, has_request_context, request, Response
+from sqlalchemy import tuple_
+from urllib.parse import urlencode
+from werkzeug.http import quote_etag
 
-from restaurants.orm import Restaurant, db, Rating, Table
+try:
+    import orjson # optional, faster json encoding
+except ImportError: # pragma: no cover
+    orjson = None
+
+from restaurants.orm import TABLES, Restaurant, db, Rating, RatingArchive, Table, bump_catalog_version, next_version, rating_histogram
 
 from restaurants.errors import Error, Error400, Error404, Error500
 
+from restaurants.search import restaurant_opening_mask
+
+from restaurants.cache import bookings_cache, entity_cache
+
+from restaurants.ratings import rated_filter
+
+from restaurants.http_client import bookings_breaker, http_client
+
 """ The list of restaurants used when the mocks are required 
     
     They are identified starting from 1.
@@ -112,25 +132,92 @@ tables = [
     {"url": "/restaurants/3/tables/6", "id":6, "restaurant_id": 3, "capacity":2},
 ]
 
+class DeadlineExceeded(Exception):
+    """ Raised when the deadline of the request (see parse_deadline) expires before a call to another service, answered with a 504 """
+
+DEADLINE = "restaurants.deadline" # the key of the deadline in the environ of the request
+
+GRPC_TIMEOUT_UNITS = {"H": 3600, "M": 60, "S": 1, "m": 1e-3, "u": 1e-6, "n": 1e-9}
+
+def parse_deadline(headers):
+    """ Return the deadline of a request (a time.monotonic() value) from its headers, None if it has none
+
+        - X-Request-Deadline: the deadline, in seconds since the epoch (e.g. 1700000000.25)
+        - grpc-timeout: the time budget, an integer followed by its unit (H, M, S, m, u, n, e.g. 500m), as in gRPC
+
+    If both are given the earliest deadline is taken, the malformed values are ignored.
+    """
+    budgets = []
+    value = headers.get("X-Request-Deadline")
+    if value is not None:
+        try:
+            budgets.append(float(value) - time.time())
+        except ValueError:
+            pass
+    match = re.fullmatch(r"(\d{1,8})([HMSmun])", (headers.get("grpc-timeout") or "").strip())
+    if match is not None:
+        budgets.append(int(match.group(1)) * GRPC_TIMEOUT_UNITS[match.group(2)])
+    if len(budgets) == 0:
+        return None
+    return time.monotonic() + min(budgets)
+
+def remaining_budget():
+    """ Return the seconds left before the deadline of the current request (negative if it expired), None if it has none """
+    if not has_request_context():
+        return None
+    deadline = request.environ.get(DEADLINE)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def deadline_headers(remaining):
+    """ Return the headers forwarding the remaining budget (in seconds) of the request to another service """
+    return {
+        "X-Request-Deadline": "%.3f" % (time.time() + remaining),
+        "grpc-timeout": "%dm" % max(0, int(remaining * 1000)),
+    }
+
 def get_from(url):
     """ Makes a get request with a timeout.
 
     Returns the json and the status code
 
     The timeout is set in config.ini or the default one is used (0.001)
+    The connections are pooled and kept alive, the connection errors are retried (see http_client.HttpClient).
+    Once the latencies of the service are known the timeout is derived from them (TIMEOUT_PERCENTILE, TIMEOUT is the longest)
+    and the slowest calls may be hedged (HEDGE_PERCENTILE).
+
+    If the request has a deadline the timeout of every attempt is cut to the remaining budget (no retry is made past it),
+    which is forwarded to the service; DeadlineExceeded is raised if it expires (before or during the call).
     """
+    remaining = remaining_budget()
+    if remaining is not None and remaining <= 0:
+        raise DeadlineExceeded()
     try:
         with current_app.app_context():
-            r = requests.get(url, timeout=current_app.config["TIMEOUT"])
+            headers = deadline = None
+            if remaining is not None:
+                headers = deadline_headers(remaining)
+                deadline = request.environ[DEADLINE]
+            r = http_client.get(url, timeout=current_app.config["TIMEOUT"], headers=headers, deadline=deadline)
             return r.json(),r.status_code
     except:
         traceback.print_exc()
+        remaining = remaining_budget()
+        if remaining is not None and remaining <= 0: # given up because of the deadline
+            raise DeadlineExceeded()
         return None,-1
 
 def get_future_bookings(restaurant_id, table_id=None):
     """ Get an array of bookings and the status code for the future booking of the specified restaurant_id
     
     Use the default ones if mocks are requested
+
+    The answers are kept for a few seconds, or until the bookings service notifies a change (see cache.BookingsCache).
+    The calls go through the circuit breaker of the bookings service (see http_client.CircuitBreaker):
+    while it is open they fail at once (None,-1) without waiting for the timeout.
+    The errors, the timeouts and the 5xx answers are its failures.
+    Raises DeadlineExceeded if the deadline of the request expires (see get_from).
     """
     if table_id is not None:
         query = "/bookings?rest=%d&table=%d&begin=%s" % (restaurant_id,table_id,datetime.datetime.now().isoformat())
@@ -145,8 +232,82 @@ def get_future_bookings(restaurant_id, table_id=None):
                     ret.append(b)
             return ret,200
         else:
-            return get_from(current_app.config["BOOK_SERVICE_URL"]+query)
+            def load():
+                ticket = bookings_breaker.allow()
+                if ticket is None:
+                    return None,-1
+                try:
+                    array,code = get_from(current_app.config["BOOK_SERVICE_URL"]+query)
+                except DeadlineExceeded: # the budget of the client, not a failure of the service
+                    bookings_breaker.cancel(ticket)
+                    raise
+                bookings_breaker.record(ticket, code != -1 and code < 500)
+                return array,code
+            return bookings_cache.get(restaurant_id, table_id, load)
             
+def encode_cursor(values):
+    """ Return an opaque cursor (a string) from the sort key values of the last returned record """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, length):
+    """ Return the sort key values stored in a cursor or None if it is not valid (length is the expected number of values) """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        return None
+    if type(values) != list or len(values) != length:
+        return None
+    for v in values:
+        if type(v) not in [int, float]:
+            return None
+    return values
+
+def keyset_filter(q, keys, values):
+    """ Filter a query ordered by keys (ascending) keeping only the records after values """
+    if len(keys) == 1:
+        return q.filter(keys[0] > values[0])
+    return q.filter(tuple_(*keys) > tuple_(*values))
+
+_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, check_circular=False)
+
+def dumps(obj):
+    """ Encode obj in (compact) json, using orjson if it is installed """
+    if orjson is not None: # pragma: no cover
+        return orjson.dumps(obj).decode()
+    return _encoder.encode(obj)
+
+def json_response(obj, status=200, headers={}):
+    """ Return an already encoded json response (skipping the generic encoder of the framework) """
+    return Response(dumps(obj), status, headers, mimetype="application/json")
+
+def next_link(cursor):
+    """ Return the Link header pointing to the next page of the current request """
+    args = request.args.to_dict()
+    args["cursor"] = cursor
+    return {"Link": '<%s?%s>; rel="next"' % (request.path, urlencode(args))}
+
+def make_etag(*values):
+    """ Return a (strong, unquoted) ETag from the values, e.g. the version of a record """
+    return "-".join([str(v) for v in values])
+
+def collection_etag(rows, more=False):
+    """ Return the ETag of a page of records from the rows (with the id and version columns)
+
+    It changes if a record of the page is written (the max version increases),
+    if the records in the page change or if there is a next page (more).
+    """
+    ids = ",".join([str(row.id) for row in rows]) + ("+" if more else "")
+    return make_etag(max([row.version or 0 for row in rows] or [0]), hashlib.sha1(ids.encode()).hexdigest()[:16])
+
+def etag_header(etag):
+    return {"ETag": quote_etag(etag)}
+
+def not_modified(etag):
+    """ Return the 304 response if the request has If-None-Match matching the etag, None otherwise """
+    if etag is not None and request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers=etag_header(etag))
+    return None
+
 def same_restaurant(rest,rest2):
     for k in rest.keys():
         if rest[k] != rest2[k]:
@@ -229,16 +390,48 @@ def valid_openings(first_opening_hour, first_closing_hour, second_opening_hour,
                 return Error400("Closing time cannot be before opening time (first)").get()
     return None
 
-def valid_rating(obj, rest_id):
+def load_restaurant(restaurant_id, fields=None):
+    """ Return the pair (version, restaurant as a dict with only the given fields, if any) or None if it does not exist """
+    serialize = Restaurant.serializer(fields)
+    row = db.session.query(*serialize.columns, Restaurant.version).filter(Restaurant.id == restaurant_id).first()
+    if row is None:
+        return None
+    return row.version, serialize(row)
+
+def load_table(table_id):
+    """ Return the pair (version, table as a dict) or None if it does not exist """
+    serialize = Table.serializer()
+    row = db.session.query(*serialize.columns, Table.version).filter(Table.id == table_id).first()
+    if row is None:
+        return None
+    return row.version, serialize(row)
+
+def load_version(model, record_id):
+    """ Return the version of a record (restaurant or table) without reading it, None if it does not exist """
+    return db.session.query(model.version).filter(model.id == record_id).scalar()
+
+def load_rating_histogram(restaurant_id):
+    """ Return the number of ratings of each value of a restaurant as a list (the index is the value), None if it does not exist """
+    row = db.session.query(*rating_histogram()).filter(Restaurant.id == restaurant_id).first()
+    if row is None:
+        return None
+    return [count or 0 for count in row]
+
+def valid_rating(obj, rest_id, use_filter=True):
     #check restaurant existing
     restaurant = db.session.query(Restaurant).filter_by(id = rest_id).first()
     if restaurant is None:
         return Error404("Restaurant not found").get()
-    #check already voted
+    #check already voted (the first ratings of a user are mostly answered by the filter, without the query)
+    if use_filter and not rated_filter.might_contain(rest_id, obj["rater_id"]):
+        return None
     q = db.session.query(Rating).filter_by(restaurant_id = rest_id)
     rating = q.filter_by(rater_id = obj["rater_id"]).first()
+    if rating is None: # it may have been archived
+        rating = db.session.query(RatingArchive.rater_id).filter_by(restaurant_id = rest_id, rater_id = obj["rater_id"]).first()
     if rating is not None:
         return Error400("Restaurant already rated by the user").get()
+    rated_filter.false_positive()
     return None
 
 def del_restaurant(restaurant_id):
@@ -246,7 +439,9 @@ def del_restaurant(restaurant_id):
         restaurant = db.session.query(Restaurant).filter_by(id = restaurant_id).first()
         
         db.session.delete(restaurant)
+        bump_catalog_version()
         db.session.commit()
+        entity_cache.invalidate("restaurant", restaurant_id)
         return True
     except:
         db.session.rollback()
@@ -258,6 +453,7 @@ def del_table(table_id):
         
         db.session.delete(restaurant)
         db.session.commit()
+        entity_cache.invalidate("table", table_id)
         return True
     except:
         db.session.rollback()
@@ -278,8 +474,11 @@ def edit_restaurant(restaurant_id, obj):
         restaurant.cuisine_type = obj["cuisine_type"]
         restaurant.menu = obj["menu"]
         restaurant.closed_days = ''.join([str(i) for i in obj["closed_days"]])
+        restaurant.opening_mask = restaurant_opening_mask(restaurant)
+        restaurant.version = next_version()
         db.session.add(restaurant)
         db.session.commit()
+        entity_cache.invalidate("restaurant", restaurant_id)
         return restaurant.id
     except:
         db.session.rollback()
@@ -300,10 +499,13 @@ def add_restaurant(obj):
         restaurant.cuisine_type = obj["cuisine_type"]
         restaurant.menu = obj["menu"]
         restaurant.closed_days = ''.join([str(i) for i in obj["closed_days"]])
+        restaurant.opening_mask = restaurant_opening_mask(restaurant)
         if "rating_val" in obj:
             restaurant.rating_val = obj["rating_val"]
         if "rating_num" in obj:
             restaurant.rating_num = obj["rating_num"]
+        restaurant.rating_sum = round((restaurant.rating_val or 0) * (restaurant.rating_num or 0))
+        restaurant.version = next_version()
         db.session.add(restaurant)
         db.session.commit()
         return restaurant.id
@@ -317,8 +519,10 @@ def edit_table(table_id, obj):
     try:
         table = db.session.query(Table).filter_by(id = table_id).first()
         table.capacity = obj["capacity"]
+        table.version = next_version(TABLES)
         db.session.add(table)
         db.session.commit()
+        entity_cache.invalidate("table", table_id)
         return table.id
     except:
         db.session.rollback()
@@ -329,6 +533,7 @@ def add_table(obj, restaurant_id):
         table = Table()
         table.capacity = obj["capacity"]
         table.restaurant_id = restaurant_id
+        table.version = next_version(TABLES)
         db.session.add(table)
         db.session.commit()
         return table.id
@@ -350,6 +555,32 @@ def add_rating(obj, restaurant_id):
         db.session.rollback()
     return None
 
+def add_ratings(rows):
+    """ Insert many ratings (restaurant_id, rater_id, rating) with one multi-row INSERT
+
+    The ratings of the users that already rated the restaurant (even in rows) are ignored by the database
+    (INSERT OR IGNORE, i.e. ON CONFLICT DO NOTHING), those of missing restaurants
+    and those already archived (see orm.RatingArchive) are dropped.
+    Returns the number of inserted ratings or None on errors
+    """
+    try:
+        rest_ids = set([row[0] for row in rows])
+        found = set([rest_id for rest_id, in db.session.query(Restaurant.id).filter(Restaurant.id.in_(rest_ids))])
+        archived = set(db.session.query(RatingArchive.restaurant_id, RatingArchive.rater_id)
+            .filter(RatingArchive.restaurant_id.in_(rest_ids), RatingArchive.rater_id.in_(set([row[1] for row in rows]))))
+        now = datetime.datetime.utcnow()
+        values = [{"restaurant_id": rest_id, "rater_id": rater_id, "rating": rating, "marked": False, "created": now}
+            for rest_id,rater_id,rating in rows if rest_id in found and (rest_id, rater_id) not in archived]
+        count = 0
+        if len(values) > 0:
+            count = db.session.execute(Rating.__table__.insert().prefix_with("OR IGNORE").values(values)).rowcount
+        db.session.commit()
+        return count
+    except:
+        traceback.print_exc()
+        db.session.rollback()
+    return None
+
 def put_fake_data():
     """
     Enter fake data (useful for testing purposes).
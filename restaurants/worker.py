@@ -2,7 +2,7 @@ from celery import Celery
 from celery.schedules import crontab
 
 from restaurants.app import create_worker_app
-from restaurants.background import check_ratings, recompute_ratings
+from restaurants.background import archive_ratings, check_ratings, flush_ratings, recompute_ratings
 
 def create_celery(app):
 
@@ -34,7 +34,17 @@ def setup_periodic_tasks(sender, **kwargs):
     
     sender.add_periodic_task(float(app.config["COMMIT_RATINGS_AFTER"]), check_ratings.s(), name=f"Mark likes and add to respective restaurants | a controll each {app.config['COMMIT_RATINGS_AFTER']} seconds")
 
+    if app.config["RATINGS_QUEUE_URL"]: # write-behind mode
+        sender.add_periodic_task(float(app.config["FLUSH_RATINGS_AFTER"]), flush_ratings.s(), name=f"Insert the queued ratings | each {app.config['FLUSH_RATINGS_AFTER']} seconds")
+
     # Executes every monday morning at 4:30 a.m. see https://docs.celeryproject.org/en/stable/userguide/periodic-tasks.html#crontab-schedules
-    sender.add_periodic_task(
-        crontab(minute=30, hour=4, day_of_week=1), recompute_ratings.s(),
-    )
\ No newline at end of file
+    if app.config["RECOMPUTE_RATINGS"]: # the ratings are exact, it only checks their consistency
+        sender.add_periodic_task(
+            crontab(minute=30, hour=4, day_of_week=1), recompute_ratings.s(),
+        )
+
+    # Executes every day at 4 a.m., before the recompute
+    if app.config["ARCHIVE_RATINGS"]:
+        sender.add_periodic_task(
+            crontab(minute=0, hour=4), archive_ratings.s(),
+        )
\ No newline at end of file